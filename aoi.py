@@ -0,0 +1,334 @@
+import codecs
+import hashlib
+import json
+import re
+import time
+import ee
+import numpy as np
+from cache import TTLCache
+from zonal import FEATURE_ID
+
+#### Area of interest helpers
+# Computed locally from the GeoJSON coordinate arrays, no Earth Engine round trip needed.
+# Coordinates are [longitude, latitude], bounds are [west, south, east, north].
+
+
+# A Polygon is a list of rings (exterior first, then holes), a MultiPolygon a list of Polygons
+def geometry_polygons(geometry_type, coordinates):
+    return [coordinates] if geometry_type == 'Polygon' else coordinates
+
+
+# Shoelace formula over a whole ring at once: area (always positive) and centroid of a closed ring
+def ring_area_centroid(ring):
+    ring = np.asarray(ring, dtype=np.float64)[:, :2]
+    x, y = ring[:, 0], ring[:, 1]
+    next_x, next_y = np.roll(x, -1), np.roll(y, -1)
+    cross = x * next_y - next_x * y
+    signed_area = cross.sum() / 2
+    if signed_area == 0:
+        # degenerate ring (line or point): no area, vertices mean as centroid
+        return 0.0, x.mean(), y.mean()
+    centroid_x = ((x + next_x) * cross).sum() / (6 * signed_area)
+    centroid_y = ((y + next_y) * cross).sum() / (6 * signed_area)
+    return abs(signed_area), centroid_x, centroid_y
+
+
+# Area weighted centroid of a Polygon/MultiPolygon: holes count as negative areas
+def geometry_centroid(geometry_type, coordinates):
+    areas, centroids = [], []
+    for polygon in geometry_polygons(geometry_type, coordinates):
+        for index, ring in enumerate(polygon):
+            area, centroid_x, centroid_y = ring_area_centroid(ring)
+            areas.append(area if index == 0 else -area)
+            centroids.append((centroid_x, centroid_y))
+    areas = np.asarray(areas)
+    centroids = np.asarray(centroids)
+    if areas.sum() <= 0:
+        return centroids.mean(axis=0).tolist()
+    return ((areas[:, None] * centroids).sum(axis=0) / areas.sum()).tolist()
+
+
+# Bounding box of a Polygon/MultiPolygon: only the exterior rings can reach the edges
+def geometry_bounds(geometry_type, coordinates):
+    exteriors = np.concatenate([np.asarray(polygon[0], dtype=np.float64)[:, :2] for polygon in geometry_polygons(geometry_type, coordinates)])
+    return exteriors.min(axis=0).tolist() + exteriors.max(axis=0).tolist()
+
+
+# Bounding box covering all the given bounding boxes (None when there are none)
+def merge_bounds(bounds_list):
+    bounds = np.asarray(bounds_list, dtype=np.float64)
+    if bounds.size == 0:
+        return None
+    return bounds[:, :2].min(axis=0).tolist() + bounds[:, 2:].max(axis=0).tolist()
+
+
+# Meters in one degree of latitude (and of longitude at the equator)
+METERS_PER_DEGREE = 111320
+
+
+# Simplification tolerance in degrees for an output scale in meters: half a pixel, anything smaller can't show
+def simplify_tolerance(scale):
+    return scale / 2 / METERS_PER_DEGREE
+
+
+# Douglas-Peucker over a vertex array: returns the mask of the vertices to keep.
+# The recursion is run one level at a time: each pass computes the deviation of every vertex from the segment between
+# its kept neighbours and keeps the farthest vertex of every segment deviating more than the tolerance, so the number
+# of passes is the recursion depth rather than the number of kept vertices.
+def douglas_peucker(points, tolerance):
+    points = np.asarray(points, dtype=np.float64)[:, :2]
+    x, y = points[:, 0], points[:, 1]
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    while True:
+        kept = np.flatnonzero(keep)
+        segment = np.cumsum(keep) - 1
+        start = kept[segment]
+        end = kept[np.minimum(segment + 1, len(kept) - 1)]
+        direction_x, direction_y = x[end] - x[start], y[end] - y[start]
+        offset_x, offset_y = x - x[start], y - y[start]
+        length = np.hypot(direction_x, direction_y)
+        # closed ring: first and last vertices are the same, use the distance to that vertex
+        closed = length == 0
+        length[closed] = 1
+        distances = np.abs(direction_x * offset_y - direction_y * offset_x) / length
+        distances[closed] = np.hypot(offset_x[closed], offset_y[closed])
+        farthest = np.maximum.reduceat(distances, kept)[segment]
+        candidates = np.flatnonzero((distances == farthest) & (distances > tolerance))
+        if not candidates.size:
+            return keep
+        # first farthest vertex of each segment
+        first = np.ones(candidates.size, dtype=bool)
+        first[1:] = segment[candidates[1:]] != segment[candidates[:-1]]
+        keep[candidates[first]] = True
+
+
+# Simplifying a ring while keeping it a valid ring: a ring that would collapse below 4 vertices
+# (a closed triangle) is kept as it is rather than turned into a line or a point
+def simplify_ring(ring, tolerance):
+    points = np.asarray(ring, dtype=np.float64)
+    if len(points) <= 4:
+        return points.tolist()
+    simplified = points[douglas_peucker(points, tolerance)]
+    return (simplified if len(simplified) >= 4 else points).tolist()
+
+
+# Whether closed rings cross or touch themselves or each other (the two edges meeting at each vertex aside).
+# Edges are sorted by their west end: an edge can only meet the edges after it starting before its east end,
+# those pairs are tested by blocks of edges.
+def rings_intersect(rings, block_size=1024):
+    edges, ring_ids, positions, ring_edges = [], [], [], []
+    for ring_id, ring in enumerate(rings):
+        points = np.asarray(ring, dtype=np.float64)[:, :2]
+        edges.append(np.hstack([points[:-1], points[1:]]))
+        ring_ids.append(np.full(len(points) - 1, ring_id))
+        positions.append(np.arange(len(points) - 1))
+        ring_edges.append(np.full(len(points) - 1, len(points) - 1))
+    edges = np.concatenate(edges)
+    order = np.argsort(np.minimum(edges[:, 0], edges[:, 2]), kind='stable')
+    edges = edges[order]
+    ring_ids, positions, ring_edges = (np.concatenate(values)[order] for values in (ring_ids, positions, ring_edges))
+    x_min, x_max = np.minimum(edges[:, 0], edges[:, 2]), np.maximum(edges[:, 0], edges[:, 2])
+    y_min, y_max = np.minimum(edges[:, 1], edges[:, 3]), np.maximum(edges[:, 1], edges[:, 3])
+    # edges after each edge overlapping it in x
+    counts = np.maximum(np.searchsorted(x_min, x_max, side='right') - np.arange(len(edges)) - 1, 0)
+
+    def orientation(a_x, a_y, b_x, b_y, c_x, c_y):
+        return np.sign((b_x - a_x) * (c_y - a_y) - (b_y - a_y) * (c_x - a_x))
+
+    for block_start in range(0, len(edges), block_size):
+        block = np.arange(block_start, min(block_start + block_size, len(edges)))
+        first = np.repeat(block, counts[block])
+        if not first.size:
+            continue
+        second = first + 1 + np.arange(first.size) - np.repeat(np.cumsum(counts[block]) - counts[block], counts[block])
+        gap = np.abs(positions[first] - positions[second])
+        neighbours = (ring_ids[first] == ring_ids[second]) & ((gap == 1) | (gap == ring_edges[first] - 1))
+        pairs = (y_min[second] <= y_max[first]) & (y_min[first] <= y_max[second]) & ~neighbours
+        p_x, p_y, q_x, q_y = edges[first[pairs]].T
+        r_x, r_y, s_x, s_y = edges[second[pairs]].T
+        # bounding boxes overlap: the edges meet when each one has the ends of the other on both sides (or on it)
+        if np.any((orientation(p_x, p_y, q_x, q_y, r_x, r_y) * orientation(p_x, p_y, q_x, q_y, s_x, s_y) <= 0) &
+                  (orientation(r_x, r_y, s_x, s_y, p_x, p_y) * orientation(r_x, r_y, s_x, s_y, q_x, q_y) <= 0)):
+            return True
+    return False
+
+
+# Simplifying the rings of a polygon, keeping the original rings when the simplified ones would cross
+# (a ring crossing itself, a hole crossing the shell...), which Earth Engine would reject or misread
+def simplify_polygon(polygon, tolerance):
+    simplified = [simplify_ring(ring, tolerance) for ring in polygon]
+    return [list(ring) for ring in polygon] if rings_intersect(simplified) else simplified
+
+
+# Simplifying every polygon of a Polygon/MultiPolygon, returns the new coordinates and the vertex counts before and after.
+# Polygons are simplified on their own: edges shared with neighbouring polygons (other features or parts of a
+# MultiPolygon) may move apart by up to the tolerance, half an output pixel, leaving slivers too thin to show.
+# A MultiPolygon whose simplified parts would cross each other is kept as it is.
+def simplify_geometry(geometry_type, coordinates, tolerance):
+    original = geometry_polygons(geometry_type, coordinates)
+    polygons = [simplify_polygon(polygon, tolerance) for polygon in original]
+    if len(polygons) > 1 and rings_intersect([ring for polygon in polygons for ring in polygon]):
+        polygons = [[list(ring) for ring in polygon] for polygon in original]
+    vertices_before = sum(len(ring) for polygon in original for ring in polygon)
+    vertices_after = sum(len(ring) for polygon in polygons for ring in polygon)
+    simplified = polygons[0] if geometry_type == 'Polygon' else polygons
+    return simplified, vertices_before, vertices_after
+
+
+# Incremental GeoJSON reader: yields the features of a file one at a time instead of loading the whole document.
+# Handles FeatureCollections ('features' list) and GeometryCollections ('geometries' list, yielded as
+# {'geometry': ...} features). Only the feature being decoded and one read chunk are held in memory.
+# Counts the features read and the time spent, for throughput reporting.
+class GeoJSONFeatureStream:
+    collection_keys = ('features', 'geometries')
+    whitespace = re.compile(r'\s*')
+    # Characters that can follow a complete value
+    value_delimiters = frozenset(',:]} \t\r\n')
+
+    def __init__(self, stream, chunk_size=1 << 16):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.count = 0
+        self.elapsed = 0.0
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self._buffer = ''
+        self._position = 0
+        self._eof = False
+
+    @property
+    def throughput(self):
+        return self.count / self.elapsed if self.elapsed else 0.0
+
+    def __iter__(self):
+        for feature in self._features():
+            self.count += 1
+            yield feature
+
+    def _features(self):
+        start = time.perf_counter()
+        try:
+            if self._next_char() != '{':
+                return
+            self._position += 1
+            while self._next_char() not in ('}', ''):
+                key = self._decode_value()
+                self._expect(':')
+                if key in self.collection_keys and self._next_char() == '[':
+                    self._position += 1
+                    while self._next_char() not in (']', ''):
+                        item = self._decode_value()
+                        if isinstance(item, dict):
+                            elapsed = time.perf_counter() - start
+                            yield item if key == 'features' else {'geometry': item}
+                            start = time.perf_counter() - elapsed
+                        if self._next_char() == ',':
+                            self._position += 1
+                    self._expect(']')
+                else:
+                    # any other member of the top-level object is decoded and dropped
+                    self._decode_value()
+                if self._next_char() == ',':
+                    self._position += 1
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+    # Reading one more chunk from the stream (doubling it when a single value does not fit), dropping parsed text
+    def _read(self, size):
+        data = self.stream.read(size)
+        self._buffer = self._buffer[self._position:] + self._text_decoder.decode(data or b'', final=not data)
+        self._position = 0
+        self._eof = not data
+
+    # Next non blank character, without consuming it ('' at the end of the stream)
+    def _next_char(self):
+        while True:
+            self._position = self.whitespace.match(self._buffer, self._position).end()
+            if self._position < len(self._buffer) or self._eof:
+                return self._buffer[self._position:self._position + 1]
+            self._read(self.chunk_size)
+
+    def _expect(self, char):
+        if self._next_char() != char:
+            raise ValueError(f"Invalid GeoJSON: expected {char!r} at character {self._position}")
+        self._position += 1
+
+    # Decoding the JSON value at the current position, reading more of the stream until it is complete.
+    # A number cut by the end of the buffer ('1.', '2e-'...) still decodes as a shorter number: a value is only
+    # trusted once the character after it is a delimiter, or at EOF.
+    def _decode_value(self):
+        self._next_char()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._position)
+                if self._eof or (end < len(self._buffer) and self._buffer[end] in self.value_delimiters):
+                    self._position = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._read(size)
+            size *= 2
+
+
+# Number of parsed AOI files kept in memory
+AOI_CACHE_SIZE = 32
+
+# Parsed AOI files keyed by the SHA-256 of their content and the simplification scale:
+# Streamlit reruns the upload processing on every interaction, unchanged files are only parsed once
+aoi_file_cache = TTLCache(maxsize=AOI_CACHE_SIZE, ttl=None)
+
+
+# SHA-256 of an uploaded file, read by chunks, leaving the file ready to be read again
+def file_sha256(upload_file, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    upload_file.seek(0)
+    for chunk in iter(lambda: upload_file.read(chunk_size), b''):
+        digest.update(chunk)
+    upload_file.seek(0)
+    return digest.hexdigest()
+
+
+# Parsing one uploaded GeoJSON file into EE geometries, their bounds, their feature names and the centroid of the
+# last one. Geometries are optionally simplified with a tolerance matching the output scale (simplify_scale in meters).
+def parse_aoi_file(upload_file, simplify_scale=None):
+    parsed = {'geometries': [], 'bounds': [], 'names': [], 'centroid': None, 'vertices_before': 0, 'vertices_after': 0}
+    # Handles GeoJSON files with a 'features' list or a 'geometries' list, files of unexpected format yield nothing
+    features = GeoJSONFeatureStream(upload_file)
+    for feature in features:
+        if 'geometry' in feature and 'coordinates' in feature['geometry']:
+            geometry_type = feature['geometry']['type']
+            coordinates = feature['geometry']['coordinates']
+            aoi_coordinates = coordinates
+            if simplify_scale:
+                aoi_coordinates, before, after = simplify_geometry(geometry_type, coordinates, simplify_tolerance(simplify_scale))
+                parsed['vertices_before'] += before
+                parsed['vertices_after'] += after
+            geometry = ee.Geometry.Polygon(aoi_coordinates) if geometry_type == 'Polygon' else ee.Geometry.MultiPolygon(aoi_coordinates)
+            parsed['geometries'].append(geometry)
+            parsed['bounds'].append(geometry_bounds(geometry_type, coordinates))
+            parsed['names'].append((feature.get('properties') or {}).get('name'))
+            parsed['centroid'] = geometry_centroid(geometry_type, coordinates)
+    parsed['feature_count'] = features.count
+    parsed['parse_time'] = features.elapsed
+    return parsed
+
+
+# Parsed content of an uploaded file, from the cache when the same content was already parsed.
+# Returns the parsed file and whether it came from the cache.
+def load_aoi_file(upload_file, simplify_scale=None):
+    key = (file_sha256(upload_file), simplify_scale)
+    parsed = aoi_file_cache.get(key)
+    if parsed is not None:
+        return parsed, True
+    parsed = parse_aoi_file(upload_file, simplify_scale)
+    parsed['sha256'] = key[0]
+    aoi_file_cache.set(key, parsed)
+    return parsed, False
+
+
+# EE features of a parsed file, keeping their identity (source file name & index) for zonal statistics
+def aoi_features(parsed, source):
+    return [ee.Feature(geometry, {FEATURE_ID: f"{source}#{index}", 'name': name}) for index, (geometry, name) in enumerate(zip(parsed['geometries'], parsed['names']))]
@@ -1,11 +1,23 @@
+import os
+import time
+_imports_start = time.perf_counter()
 import streamlit as st
 import ee
-import geemap
-import folium
-from folium import WmsTileLayer
-from streamlit_folium import folium_static
 from datetime import datetime, timedelta
-import json
+from aoi import load_aoi_file, aoi_features, merge_bounds
+from layers import map_id_executor, statistics_executor, shared_cache_stats
+from stages import build_mndwi_pipeline
+from engine import transition_vis_params, TRANSITION_UNCHANGED, TRANSITION_WETTER, TRANSITION_DRIER
+from collection import SENTINEL2, COMPOSITE_MODES, DEFAULT_SCENE_LIMIT, date_window
+from session import get_pipeline_state
+from scheduler import ee_scheduler
+import offline
+from zonal import rows_csv
+from timeseries import TimeSeriesStore, series_windows, series_key, run_series, series_rows
+from tracing import Tracer, current_tracer, span, submit, record_startup, startup_summary
+# Importing the modules above: only the first execution of this script in the process (cold start) really imports them.
+# geemap, folium & streamlit_folium are imported when first needed, once the page has started rendering.
+record_startup('imports', time.perf_counter() - _imports_start)
 
 st.set_page_config(
     page_title="MNDWI Viewer",
@@ -149,93 +161,114 @@ st.markdown(
 # geemap auth + initialization for cloud deployment
 @st.cache_data(persist=True)
 def ee_authenticate(token_name="EARTHENGINE_TOKEN"):
+    import geemap
     geemap.ee_initialize(token_name=token_name)
 
-ee.Initialize(project='ee-malik')
+# Earth Engine is initialized once per process, by the first run needing it, not on every execution of this script
+# (Streamlit re-executes it on each rerun, see offline.initialize_once)
+def ee_initialize():
+    offline.initialize_once(project='ee-malik')
+    ee_authenticate(token_name="EARTHENGINE_TOKEN")
 
-# Earth Engine drawing method setup
-def add_ee_layer(self, ee_image_object, vis_params, name):
-    map_id_dict = ee.Image(ee_image_object).getMapId(vis_params)
+# Adding an Earth Engine tile layer (tile url from the layer stages, see stages.py) to a folium map
+def add_ee_tile_layer(folium_map, tiles, name):
+    import folium
     layer = folium.raster_layers.TileLayer(
-        tiles=map_id_dict['tile_fetcher'].url_format,
+        tiles=tiles,
         attr='Map Data &copy; <a href="https://earthengine.google.com/">Google Earth Engine</a>',
         name=name,
         overlay=True,
         control=True
     )
-    layer.add_to(self)
+    layer.add_to(folium_map)
     return layer
 
-# Configuring Earth Engine display rendering method in Folium
-folium.Map.add_ee_layer = add_ee_layer
+# Satellite imagery used by the app (see collection.py)
+SENSOR = SENTINEL2
+# Output scale of the imagery in meters
+OUTPUT_SCALE = SENSOR['scale']
 
-# Defining a function to create and filter a GEE image collection for results
-def satCollection(cloudRate, initialDate, updatedDate, aoi):
-    collection = ee.ImageCollection('COPERNICUS/S2_SR') \
-        .filter(ee.Filter.lt("CLOUDY_PIXEL_PERCENTAGE", cloudRate)) \
-        .filterDate(initialDate, updatedDate) \
-        .filterBounds(aoi)
-    
-    # Defining a function to clip the colleciton to the area of interst
-    def clipCollection(image):
-        return image.clip(aoi).divide(10000)
-    # clipping the collection
-    collection = collection.map(clipCollection)
-    return collection
+#### Satellite imagery processing stages (see stages.py)
+pipeline = build_mndwi_pipeline(SENSOR)
+# Weekly statistics of the time series, stored across sessions and restarts (see timeseries.py)
+timeseries_store = TimeSeriesStore()
+# JSON lines log the traced runs are appended to, when set (see tracing.py)
+TRACE_LOG = os.environ.get('MNDWI_TRACE_LOG')
 
 # Upload function
-# Define a global variable to store the centroid of the last uploaded geometry
-last_uploaded_centroid = None
-def upload_files_proc(upload_files):
-    # A global variable to track the latest geojson uploaded
-    global last_uploaded_centroid
+# The AOI, the centroid of the last uploaded geometry and the bounds [west, south, east, north] of all uploaded
+# geometries are stored in the session pipeline state (see session.py), so sessions don't overwrite each other
+# Optionally simplifying the geometries with a tolerance matching the output scale (simplify_scale in meters)
+def upload_files_proc(upload_files, state, simplify_scale=None):
     # Setting up a variable that takes all polygons/geometries within the same/different geojson
     geometry_aoi_list = []
+    geometry_bounds_list = []
+    # Content hashes of the uploaded files, identifying the AOI in the session results (with the simplification scale)
+    aoi_key = []
+    # Uploaded features keeping their identity (file name & index) for zonal statistics
+    feature_list = []
+    last_uploaded_centroid = None
+    # Features read and time spent reading them, to report the parsing throughput
+    feature_count = 0
+    parse_time = 0
+    # Vertices sent to Earth Engine before and after simplification
+    vertices_before = 0
+    vertices_after = 0
+    # Files unchanged since a previous run
+    cached_files = 0
 
     for upload_file in upload_files:
-        bytes_data = upload_file.read()
-        geojson_data = json.loads(bytes_data)
-
-        if 'features' in geojson_data and isinstance(geojson_data['features'], list):
-            # Handle GeoJSON files with a 'features' list
-            features = geojson_data['features']
-        elif 'geometries' in geojson_data and isinstance(geojson_data['geometries'], list):
-            # Handle GeoJSON files with a 'geometries' list
-            features = [{'geometry': geo} for geo in geojson_data['geometries']]
+        # Files are parsed once per content (see aoi.py): unchanged uploads are reused on reruns
+        parsed, cached = load_aoi_file(upload_file, simplify_scale)
+        geometry_aoi_list.extend(parsed['geometries'])
+        geometry_bounds_list.extend(parsed['bounds'])
+        aoi_key.append(parsed['sha256'])
+        feature_list.extend(aoi_features(parsed, upload_file.name))
+
+        # Update the last uploaded centroid (computed locally, see aoi.py)
+        if parsed['centroid'] is not None:
+            last_uploaded_centroid = parsed['centroid']
+
+        if cached:
+            cached_files += 1
         else:
-            # handling cases of unexpected file format or missing 'features' or 'geometries'
-            continue
-
-        for feature in features:
-            if 'geometry' in feature and 'coordinates' in feature['geometry']:
-                coordinates = feature['geometry']['coordinates']
-                geometry = ee.Geometry.Polygon(coordinates) if feature['geometry']['type'] == 'Polygon' else ee.Geometry.MultiPolygon(coordinates)
-                geometry_aoi_list.append(geometry)
-
-                # Update the last uploaded centroid
-                last_uploaded_centroid = geometry.centroid(maxError=1).getInfo()['coordinates']
+            feature_count += parsed['feature_count']
+            parse_time += parsed['parse_time']
+        vertices_before += parsed['vertices_before']
+        vertices_after += parsed['vertices_after']
+
+    if feature_count and parse_time:
+        st.caption(f"{feature_count} features read at {feature_count / parse_time:,.0f} features/s")
+    if cached_files:
+        st.caption(f"{cached_files} unchanged file(s) reused")
+    if vertices_before:
+        st.caption(f"AOI simplified from {vertices_before:,} to {vertices_after:,} vertices")
 
     if geometry_aoi_list:
         geometry_aoi = ee.Geometry.MultiPolygon(geometry_aoi_list)
     else:
         geometry_aoi = ee.Geometry.Point([27.98, 36.13])
 
+    state.aoi = geometry_aoi
+    state.features = ee.FeatureCollection(feature_list) if feature_list else None
+    state.aoi_key = tuple(aoi_key) + (simplify_scale,)
+    state.centroid = last_uploaded_centroid
+    state.bounds = merge_bounds(geometry_bounds_list)
     return geometry_aoi
 
 
 # Time input processing function
 def date_input_proc(input_date, time_range):
-    end_date = input_date
-    start_date = input_date - timedelta(days=time_range)
-    
-    str_start_date = start_date.strftime('%Y-%m-%d')
-    str_end_date = end_date.strftime('%Y-%m-%d')
+    str_start_date, str_end_date = date_window(input_date, time_range)
     return str_start_date, str_end_date
 
 # Main function to run the Streamlit app
 def main():
-    # initiate gee 
-    ee_authenticate(token_name="EARTHENGINE_TOKEN")
+    # initiate gee (once per process)
+    ee_initialize()
+
+    # results of this session (see session.py)
+    state = get_pipeline_state()
 
     # sidebar
     with st.sidebar:
@@ -254,6 +287,11 @@ def main():
                 - [About](#about)
                 - [Credit](#credit)
             """)
+
+    # Performance panel: timing spans & Earth Engine requests of this run, only recorded when enabled (see tracing.py)
+    performance_panel = st.sidebar.expander("Performance")
+    tracer = Tracer(app=os.path.basename(__file__)) if performance_panel.checkbox("Record timings", value=False) else None
+    current_tracer.set(tracer)
     
         
     with st.container():
@@ -269,13 +307,26 @@ def main():
             ## Cloud coverage input
                 st.info("Cloud Coverage 🌥️")
                 cloud_pixel_percentage = st.slider(label="cloud pixel rate", min_value=5, max_value=100, step=5, value=85 , label_visibility="collapsed")
+
+            ## Compositing input: fewer scenes render faster, more scenes give a cleaner composite
+                st.info("Compositing 🧩")
+                composite_mode = st.selectbox("Compositing mode", list(COMPOSITE_MODES), format_func=COMPOSITE_MODES.get, label_visibility="collapsed")
+                scene_limit = st.slider(label="Least cloudy scenes (N)", min_value=1, max_value=20, value=DEFAULT_SCENE_LIMIT)
                 
             ## File upload
                 # User input GeoJSON file
                 st.info("Upload Area Of Interest file:")
                 upload_files = st.file_uploader("Crete a GeoJSON file at: [geojson.io](https://geojson.io/)", accept_multiple_files=True)
+                # Simplifying detailed AOIs (e.g. coastlines) makes Earth Engine requests smaller and clipping cheaper
+                simplify_aoi = st.checkbox("Simplify AOI geometry", value=False, help=f"Drops vertices closer than half a pixel ({OUTPUT_SCALE / 2:g} m) to the outline")
                 # calling upload files function
-                geometry_aoi = upload_files_proc(upload_files)
+                with span("upload_files_proc", files=len(upload_files)):
+                    geometry_aoi = upload_files_proc(upload_files, state, simplify_scale=OUTPUT_SCALE if simplify_aoi else None)
+
+            ## Zonal statistics input: flooded area per uploaded polygon and per class
+                zonal_statistics = st.checkbox("Zonal statistics per AOI polygon", value=False)
+                zonal_scale = st.number_input("Statistics scale (m)", min_value=OUTPUT_SCALE, max_value=1000, value=OUTPUT_SCALE, step=OUTPUT_SCALE)
+                tile_scale = st.select_slider("Tile scale", options=[1, 2, 4, 8, 16], value=1, help="Higher values use less Earth Engine memory per tile on large AOIs")
             
             ## Accessibility: Color palette input
                 st.info("Custom Color Palettes")
@@ -329,13 +380,19 @@ def main():
     #### User input section - END
 
             #### Map section - START
-            global last_uploaded_centroid
+            # Map modules: imported on the first run only, after the page started rendering
+            import folium
+            from streamlit_folium import folium_static
 
             # Create the initial map
-            if last_uploaded_centroid is not None:
-                latitude = last_uploaded_centroid[1]
-                longitude = last_uploaded_centroid[0]
+            if state.centroid is not None:
+                latitude = state.centroid[1]
+                longitude = state.centroid[0]
                 m = folium.Map(location=[latitude, longitude], tiles=None, zoom_start=12, control_scale=True)
+                # Fit the map to all uploaded geometries
+                if state.bounds is not None:
+                    west, south, east, north = state.bounds
+                    m.fit_bounds([[south, west], [north, east]])
             else:
                 # Default location if no file is uploaded
                 m = folium.Map(location=[36.45, 10.85], tiles=None, zoom_start=4, control_scale=True)
@@ -351,21 +408,6 @@ def main():
             b1.add_to(m)
 
             #### Satellite imagery Processing Section - START
-            ## Defining and clipping image collections for both dates:
-            # initial Image collection
-            initial_collection = satCollection(cloud_pixel_percentage, str_initial_start_date, str_initial_end_date, geometry_aoi)
-            # updated Image collection
-            updated_collection = satCollection(cloud_pixel_percentage, str_updated_start_date, str_updated_end_date, geometry_aoi)
-
-            # setting a sat_imagery variable that could be used for various processes later on (tci, mndwi... etc)
-            initial_sat_imagery = initial_collection.median()
-            updated_sat_imagery = updated_collection.median()
-
-            ## TCI (True Color Imagery)
-            # Clipping the image to the area of interest "aoi"
-            initial_tci_image = initial_sat_imagery
-            updated_tci_image = updated_sat_imagery
-
             # TCI image visual parameters
             tci_params = {
             'bands': ['B4', 'B3', 'B2'], #using Red, Green & Blue bands for TCI.
@@ -374,17 +416,6 @@ def main():
             'gamma': 1
             }
 
-            ## Other imagery processing operations go here 
-            # mndwi
-            def getmndwi(collection):
-                green_band = 'B3'  # Update with the correct band name for red
-                swir_band = 'B11'  # Update with the correct band name for SWIR
-                return collection.normalizedDifference(['B3', 'B11'])
-
-            # clipping to AOI
-            initial_mndwi = getmndwi(initial_sat_imagery)
-            updated_mndwi = getmndwi(updated_sat_imagery)
-
             # mndwi visual parameters:
             mndwi_params = {
             'min': 0,
@@ -392,29 +423,6 @@ def main():
             'palette': mndwi_palette
             }
 
-            # Masking mndwi over the water & show only land
-            def satImageMask(sat_image):
-                masked_image = sat_image.updateMask(sat_image.gte(0))
-                return masked_image
-            
-            # Mask mndwi images
-            initial_mndwi = satImageMask(initial_mndwi)
-            updated_mndwi = satImageMask(updated_mndwi)
-
-            # ##### mndwi classification: 7 classes
-            def classify_mndwi(masked_image): # better use a masked image to avoid water bodies obstracting the result as possible
-                mndwi_classified = ee.Image(masked_image) \
-                .where(masked_image.gte(-1).And(masked_image.lt(-0.1)), 1) \
-                .where(masked_image.gte(0).And(masked_image.lt(0.2)), 2) \
-                .where(masked_image.gte(0.21).And(masked_image.lt(0.35)), 3) \
-                .where(masked_image.gte(0.35).And(masked_image.lt(0.45)), 4) \
-                .where(masked_image.gte(0.45).And(masked_image.lt(0.65)), 5)             
-                return mndwi_classified
-
-            # Classify masked mndwi
-            initial_mndwi_classified = classify_mndwi(initial_mndwi)
-            updated_mndwi_classified = classify_mndwi(updated_mndwi)
-
             # Classified mndwi visual parameters
             mndwi_classified_params = {
             'min': 1,
@@ -423,29 +431,99 @@ def main():
             # each color corresponds to an mndwi class.
             }
 
+            # Stage inputs for both dates: the collections, composites, mndwi & layers are computed by the stage graph
+            # and kept in the session state (the AOI is identified by the content hash of the uploaded files)
+            initial_inputs = {
+                'aoi': geometry_aoi,
+                'cloud_rate': cloud_pixel_percentage,
+                'composite_mode': composite_mode,
+                # the scene limit only matters in 'least_cloudy' mode, leaving it out keeps the other modes cached
+                'scene_limit': scene_limit if composite_mode == 'least_cloudy' else None,
+                'start_date': str_initial_start_date,
+                'end_date': str_initial_end_date,
+                'tci_params': tci_params,
+                'mndwi_params': mndwi_params,
+                'mndwi_classified_params': mndwi_classified_params,
+                'features': state.features,
+                'aoi_bounds': state.bounds,
+                'zonal_scale': zonal_scale,
+                'tile_scale': tile_scale,
+            }
+            updated_inputs = dict(initial_inputs, start_date=str_updated_start_date, end_date=str_updated_end_date)
+
+            # Flood change visual parameters: mndwi difference, drier in red, wetter in blue
+            change_params = {
+            'bands': ['mndwi_change'],
+            'min': -0.5,
+            'max': 0.5,
+            'palette': ["#a50026", "#f46d43", "#f7f7f7", "#74add1", "#313695"]
+            }
+            # Class transition band of the same image (from * 10 + to): unchanged, wetter or drier by the classes crossed
+            transition_params = transition_vis_params(SENSOR['mndwi_classes'])
+            change_inputs = {'initial': initial_inputs, 'updated': updated_inputs, 'change_params': change_params, 'transition_params': transition_params}
+
             #### Satellite imagery Processing Section - END
 
             #### Layers section - START
             # Check if the initial and updated dates are the same
             if initial_date == updated_date:
                 # Only display the layers based on the updated date without dates in their names
-                m.add_ee_layer(updated_tci_image, tci_params, 'Satellite Imagery')
-                m.add_ee_layer(updated_mndwi, mndwi_params, 'Raw mndwi')
-                m.add_ee_layer(updated_mndwi_classified, mndwi_classified_params, 'Reclassified mndwi')
+                layers = [
+                    ('tci_layer', updated_inputs, 'Satellite Imagery'),
+                    ('mndwi_layer', updated_inputs, 'Raw mndwi'),
+                    ('classified_mndwi_layer', updated_inputs, 'Reclassified mndwi'),
+                ]
             else:
                 # Show both dates in the appropriate layers
-                # Satellite image
-                m.add_ee_layer(initial_tci_image, tci_params, f'Initial Satellite Imagery: {initial_date}')
-                m.add_ee_layer(updated_tci_image, tci_params, f'Updated Satellite Imagery: {updated_date}')
-
-                # mndwi
-                m.add_ee_layer(initial_mndwi, mndwi_params, f'Initial Raw mndwi: {initial_date}')
-                m.add_ee_layer(updated_mndwi, mndwi_params, f'Updated Raw mndwi: {updated_date}')
-
-                # Add layers to the second map (m.m2)
-                # Classified mndwi
-                m.add_ee_layer(initial_mndwi_classified, mndwi_classified_params, f'Initial Reclassified mndwi: {initial_date}')
-                m.add_ee_layer(updated_mndwi_classified, mndwi_classified_params, f'Updated Reclassified mndwi: {updated_date}')
+                layers = [
+                    # Satellite image
+                    ('tci_layer', initial_inputs, f'Initial Satellite Imagery: {initial_date}'),
+                    ('tci_layer', updated_inputs, f'Updated Satellite Imagery: {updated_date}'),
+                    # mndwi
+                    ('mndwi_layer', initial_inputs, f'Initial Raw mndwi: {initial_date}'),
+                    ('mndwi_layer', updated_inputs, f'Updated Raw mndwi: {updated_date}'),
+                    # Classified mndwi
+                    ('classified_mndwi_layer', initial_inputs, f'Initial Reclassified mndwi: {initial_date}'),
+                    ('classified_mndwi_layer', updated_inputs, f'Updated Reclassified mndwi: {updated_date}'),
+                    # Flood change between both dates
+                    ('change_layer', change_inputs, f'mndwi Change: {initial_date} to {updated_date}'),
+                    ('transition_layer', change_inputs, f'Class Transitions: {initial_date} to {updated_date}'),
+                ]
+
+            # Number of scenes behind each composite, shown under the map
+            scene_counts = [('scene_count', initial_inputs, f'Initial composite: {initial_date}'), ('scene_count', updated_inputs, f'Updated composite: {updated_date}')]
+            if initial_date == updated_date:
+                scene_counts = [('scene_count', updated_inputs, 'Composite')]
+
+            # Zonal statistics of each date, only when asked for and when polygons were uploaded
+            zonal_stats = []
+            if zonal_statistics and state.features is not None:
+                zonal_stats = [('zonal_stats', updated_inputs, str(updated_date))]
+                if initial_date != updated_date:
+                    zonal_stats.insert(0, ('zonal_stats', initial_inputs, str(initial_date)))
+
+            # Layer tile urls, scene counts and statistics are requested concurrently, layers are added to the map in order.
+            # Statistics go to their own executor, the map id executor only runs the quick (interactive) requests.
+            requests = layers + scene_counts
+            stage_keys = {'aoi': state.aoi_key, 'features': state.aoi_key}
+            with span("pipeline requests", requests=len(requests) + len(zonal_stats)):
+                statistics = [submit(statistics_executor, pipeline.run, stage, inputs, state.stages, stage_keys) for stage, inputs, _ in zonal_stats]
+                results = pipeline.run_many([(stage, inputs) for stage, inputs, _ in requests], state.stages, keys=stage_keys, executor=map_id_executor)
+                results += [future.result() for future in statistics]
+            with span("add layers", layers=len(layers)):
+                for tiles, (_, _, name) in zip(results, layers):
+                    add_ee_tile_layer(m, tiles, name)
+            scene_count_caption = " | ".join(f"{name}: {count} scene(s)" for count, (_, _, name) in zip(results[len(layers):], scene_counts))
+            # one table for all dates, with the date as first column
+            zonal_table = [dict({'date': date}, **row) for rows, (_, _, date) in zip(results[len(layers) + len(scene_counts):], zonal_stats) for row in rows]
+
+            # Stage graph cache counters
+            with st.sidebar.expander("Pipeline cache"):
+                st.table(state.stages.stats())
+                # Earth Engine requests shared by every session: coalesced = identical requests that waited for one in flight
+                st.table(shared_cache_stats())
+                # Earth Engine calls: running/waiting in the scheduler, retried after throttling errors
+                st.table({'Earth Engine requests': ee_scheduler.stats()})
 
 
             #### Layers section - END
@@ -457,13 +535,61 @@ def main():
         submitted = c2.form_submit_button("Generate map")
         if submitted:
             with c1:
-                folium_static(m)
+                with span("folium_static"):
+                    folium_static(m)
+                st.caption(scene_count_caption)
         else:
             with c1:
-                folium_static(m)
+                with span("folium_static"):
+                    folium_static(m)
+                st.caption(scene_count_caption)
 
     #### Map result display - END
 
+    #### Zonal statistics - START
+    if zonal_table:
+        with st.container():
+            st.subheader("Zonal Statistics:")
+            st.caption(f"mndwi class areas per uploaded polygon, in hectares (scale: {zonal_scale} m)")
+            st.dataframe(zonal_table, use_container_width=True)
+            st.download_button("Download CSV", rows_csv(zonal_table), file_name="mndwi_zonal_statistics.csv", mime="text/csv")
+    #### Zonal statistics - END
+
+    #### Time series - START
+    # Weekly mndwi statistics of the uploaded AOI with the cloud & compositing inputs above:
+    # windows already in the store are read back, only the missing ones are computed
+    if state.features is not None:
+        with st.expander("Weekly time series"):
+            with st.form("timeseries_form"):
+                series_from = st.date_input("From", value=delay - timedelta(days=365))
+                series_submitted = st.form_submit_button("Compute time series")
+            if series_submitted:
+                series = series_key(state.aoi_key, SENSOR, cloud_pixel_percentage, composite_mode, initial_inputs['scene_limit'], zonal_scale)
+                windows = series_windows(series_from, delay.date())
+                with st.spinner(f"Computing the time series ({len(windows)} weeks)"):
+                    series_stats, computed = run_series(pipeline, state.stages, timeseries_store, series, windows, updated_inputs, keys={'aoi': state.aoi_key, 'features': state.aoi_key})
+                series_table = series_rows(series_stats, [value for _, _, value in SENSOR['mndwi_classes']])
+                st.caption(f"{len(windows) - computed} week(s) from the store, {computed} computed")
+                if series_table:
+                    # class areas (ha) of each week, by window end date
+                    st.line_chart(series_table, x='end', y=[column for column in series_table[0] if column.startswith('class ')])
+                st.dataframe(series_table, use_container_width=True)
+                st.download_button("Download CSV", rows_csv(series_table), file_name="mndwi_time_series.csv", mime="text/csv")
+    #### Time series - END
+
+    #### Performance panel - START
+    with performance_panel:
+        # cold start of this server process: module imports, Earth Engine initialization
+        st.table(startup_summary())
+    if tracer is not None:
+        with performance_panel:
+            st.table(tracer.span_summary())
+            st.table(tracer.request_summary())
+            st.download_button("Download JSON lines", tracer.jsonl(), file_name=f"mndwi_trace_{tracer.run_id}.jsonl", mime="application/x-ndjson")
+        if TRACE_LOG:
+            tracer.export(TRACE_LOG)
+    #### Performance panel - END
+
     #### Legend - START
     with st.container():
         st.subheader("Map Legend:")
@@ -505,6 +631,23 @@ def main():
             # Display the Reclassified mndwi legend using st.markdown
             st.markdown(reclassified_mndwi_legend_html, unsafe_allow_html=True)
 
+        with col5:
+            # Legend of the class transition layer (shown when the two dates differ)
+            transition_legend_html = """
+                <div class="reclassifiedmndwi">
+                    <h5>Class Transitions</h5>
+                    <p style="margin: 0.2em 0px;">Code = initial class &times; 10 + updated class (e.g. 25: class 2 &rarr; class 5)</p>
+                    <ul style="list-style-type: none; padding: 0;">
+                        <li style="margin: 0.2em 0px; padding: 0;"><span style="color: {6};">&#9632;</span><span style="color: {5};">&#9632;</span><span style="color: {4};">&#9632;</span> Wetter by 3+ / 2 / 1 class(es)</li>
+                        <li style="margin: 0.2em 0px; padding: 0;"><span style="color: {0};">&#9632;</span> Unchanged class</li>
+                        <li style="margin: 0.2em 0px; padding: 0;"><span style="color: {1};">&#9632;</span><span style="color: {2};">&#9632;</span><span style="color: {3};">&#9632;</span> Drier by 1 / 2 / 3+ class(es)</li>
+                    </ul>
+                </div>
+            """.format(TRANSITION_UNCHANGED, *TRANSITION_DRIER, *TRANSITION_WETTER)
+
+            # Display the class transition legend using st.markdown
+            st.markdown(transition_legend_html, unsafe_allow_html=True)
+
     #### Legend - END
 
     #### Miscs Infos - START
@@ -0,0 +1,158 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date
+import ee
+from aoi import load_aoi_file, aoi_features, merge_bounds
+from collection import SENSORS, COMPOSITE_MODES, DEFAULT_SCENE_LIMIT, date_window
+from pipeline import StageResults
+import offline
+from stages import build_mndwi_pipeline
+from zonal import rows_csv
+from tracing import Tracer, current_tracer, span, submit
+
+#### Headless batch runner
+# Runs the mndwi pipeline over every GeoJSON AOI of a directory and every given date, without Streamlit.
+# Each job (AOI, date) writes its statistics and layer tile urls to <output>/<aoi name>/<date>.json (+ .csv).
+# A job whose output already exists is skipped, so a crashed or interrupted run resumes where it stopped.
+#
+# Usage: python batch.py AOI_DIR --dates 2023-10-01 2023-10-08 --output results [--workers 4]
+# Earth Engine requests can be recorded to / replayed from a cassette with MNDWI_EE_RECORD / MNDWI_EE_REPLAY (see offline.py).
+
+# Default visual parameters of the layers written with each job (same as the app's default palettes)
+LAYER_PARAMS = {
+    'tci_params': {'bands': ['B4', 'B3', 'B2'], 'min': 0, 'max': 1, 'gamma': 1},
+    'mndwi_params': {'min': 0, 'max': 1, 'palette': ["#ffffe5", "#f7fcb9", "#78c679", "#41ab5d", "#238443", "#005a32"]},
+    'mndwi_classified_params': {'min': 1, 'max': 7, 'palette': ["#a50026", "#ed5e3d", "#f9f7ae", "#f4ff78", "#9ed569", "#229b51", "#006837"]},
+}
+LAYER_STAGES = ['tci_layer', 'mndwi_layer', 'classified_mndwi_layer']
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the mndwi pipeline over many AOIs and dates.")
+    parser.add_argument('aoi_dir', help="directory of GeoJSON AOI files")
+    parser.add_argument('--dates', nargs='+', required=True, type=date.fromisoformat, help="end dates of the image windows (YYYY-MM-DD)")
+    parser.add_argument('--output', default='results', help="output directory (default: results)")
+    parser.add_argument('--window', type=int, default=7, help="days of imagery leading to each date (default: 7)")
+    parser.add_argument('--cloud-rate', type=int, default=85, help="maximum cloudy pixel percentage (default: 85)")
+    parser.add_argument('--sensor', choices=list(SENSORS), default='sentinel2')
+    parser.add_argument('--composite-mode', choices=list(COMPOSITE_MODES), default='median')
+    parser.add_argument('--scene-limit', type=int, default=DEFAULT_SCENE_LIMIT, help="scenes of the 'least_cloudy' mode")
+    parser.add_argument('--scale', type=int, help="zonal statistics scale in meters (default: the sensor scale)")
+    parser.add_argument('--tile-scale', type=int, default=1, help="reduceRegions tileScale (default: 1)")
+    parser.add_argument('--simplify', action='store_true', help="simplify the AOI geometries to the output scale")
+    parser.add_argument('--no-layers', action='store_true', help="only write statistics, no layer tile urls")
+    parser.add_argument('--workers', type=int, default=4, help="jobs running at the same time (default: 4)")
+    parser.add_argument('--project', help="Earth Engine cloud project")
+    parser.add_argument('--trace', help="append the timing spans & Earth Engine requests of each job to this JSON lines file")
+    return parser.parse_args(argv)
+
+
+# Parsed AOI files of a directory: {name: parsed file}, files without polygons are left out
+def load_aois(aoi_dir, simplify_scale=None):
+    aois = {}
+    for file_name in sorted(os.listdir(aoi_dir)):
+        if not file_name.lower().endswith(('.geojson', '.json')):
+            continue
+        with open(os.path.join(aoi_dir, file_name), 'rb') as aoi_file:
+            parsed, _ = load_aoi_file(aoi_file, simplify_scale)
+        if parsed['geometries']:
+            aois[os.path.splitext(file_name)[0]] = dict(parsed, file_name=file_name)
+        else:
+            print(f"skipping {file_name}: no polygon found", file=sys.stderr)
+    return aois
+
+
+def job_path(output, aoi_name, job_date):
+    return os.path.join(output, aoi_name, f"{job_date.isoformat()}.json")
+
+
+# Writing a file through a temporary one: a job output either exists complete or not at all
+def write_atomic(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, 'w', encoding='utf-8') as output_file:
+        output_file.write(text)
+    os.replace(temporary_path, path)
+
+
+# Running one (AOI, date) job through the stage graph and writing its outputs
+# (jobs are submitted with tracing.submit, each one runs in its own context and can have its own tracer)
+def run_job(pipeline, results, args, aoi_name, parsed, job_date):
+    tracer = Tracer(aoi=aoi_name, date=job_date.isoformat()) if args.trace else None
+    current_tracer.set(tracer)
+    with span("job"):
+        job = compute_job(pipeline, results, args, aoi_name, parsed, job_date)
+    if tracer is not None:
+        tracer.export(args.trace)
+    return job
+
+
+def compute_job(pipeline, results, args, aoi_name, parsed, job_date):
+    start_date, end_date = date_window(job_date, args.window)
+    inputs = dict(
+        LAYER_PARAMS,
+        aoi=ee.Geometry.MultiPolygon(parsed['geometries']),
+        cloud_rate=args.cloud_rate,
+        start_date=start_date,
+        end_date=end_date,
+        composite_mode=args.composite_mode,
+        scene_limit=args.scene_limit if args.composite_mode == 'least_cloudy' else None,
+        features=ee.FeatureCollection(aoi_features(parsed, parsed['file_name'])),
+        aoi_bounds=merge_bounds(parsed['bounds']),
+        zonal_scale=args.scale or SENSORS[args.sensor]['scale'],
+        tile_scale=args.tile_scale,
+    )
+    keys = {'aoi': parsed['sha256'], 'features': parsed['sha256']}
+    job = {
+        'aoi': aoi_name,
+        'date': job_date.isoformat(),
+        'window': [start_date, end_date],
+        'sensor': args.sensor,
+        'cloud_rate': args.cloud_rate,
+        'composite_mode': args.composite_mode,
+        'scene_count': pipeline.run('scene_count', inputs, results, keys),
+        'zonal_stats': pipeline.run('zonal_stats', inputs, results, keys),
+    }
+    if not args.no_layers:
+        job['layers'] = {stage: pipeline.run(stage, inputs, results, keys) for stage in LAYER_STAGES}
+    path = job_path(args.output, aoi_name, job_date)
+    write_atomic(os.path.splitext(path)[0] + '.csv', rows_csv(job['zonal_stats']))
+    write_atomic(path, json.dumps(job, indent=2))
+    return job
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    offline.initialize_once(project=args.project)
+    sensor = SENSORS[args.sensor]
+    pipeline = build_mndwi_pipeline(sensor)
+    aois = load_aois(args.aoi_dir, sensor['scale'] if args.simplify else None)
+
+    jobs = [(aoi_name, job_date) for aoi_name in aois for job_date in args.dates]
+    pending = [(aoi_name, job_date) for aoi_name, job_date in jobs if not os.path.exists(job_path(args.output, aoi_name, job_date))]
+    print(f"{len(jobs)} jobs, {len(jobs) - len(pending)} already done, {len(pending)} to run")
+
+    # Results are only shared between the stages of a job, they don't need to outlive it
+    results = StageResults(maxsize=32 * max(args.workers, 1))
+    failures = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {submit(executor, run_job, pipeline, results, args, aoi_name, aois[aoi_name], job_date): (aoi_name, job_date) for aoi_name, job_date in pending}
+        for done, future in enumerate(as_completed(futures), start=1):
+            aoi_name, job_date = futures[future]
+            try:
+                job = future.result()
+                print(f"[{done}/{len(pending)}] {aoi_name} {job_date}: {job['scene_count']} scene(s)")
+            except Exception as error:
+                failures += 1
+                print(f"[{done}/{len(pending)}] {aoi_name} {job_date}: failed ({error})", file=sys.stderr)
+    print(f"{len(pending) - failures} jobs done, {failures} failed in {time.perf_counter() - start:.1f} s")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,447 @@
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+import ee
+from engine import get_backend, MNDWI_CLASSES
+from aoi import GeoJSONFeatureStream, simplify_geometry, simplify_tolerance, geometry_bounds, geometry_centroid
+from collection import SENTINEL2, COMPOSITE_MODES, DEFAULT_SCENE_LIMIT, sat_collection, composite_scenes, sat_composite
+import layers
+import raster
+import batch
+import offline
+from scheduler import RequestScheduler, INTERACTIVE, BACKGROUND
+from tracing import context_map
+
+#### Benchmarks for the mndwi pipeline
+# Everything runs locally on synthetic data and stub/fake Earth Engine clients, no network needed. The benchmarks
+# building Earth Engine expressions need the algorithm list of an Earth Engine client: they replay it from a
+# recorded cassette (MNDWI_EE_REPLAY, see offline.py) and are skipped without one.
+# Each benchmark prints its results and returns its metrics {name: value}, all lower is better (seconds, ns/pixel,
+# bytes). Metrics can be saved as a JSON baseline, and a later run compared to it fails (exit status 1) when a
+# metric regresses by more than the threshold percentage.
+#
+# Usage: python benchmark.py [benchmark name ...] [--save baseline.json] [--baseline baseline.json] [--threshold 25]
+#        (all benchmarks when no name is given)
+
+
+# Best wall time of a few runs, in seconds
+def timeit(func, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+# Synthetic masked mndwi raster: values in [-1, 1] with ~10% masked (NaN) pixels
+def synthetic_mndwi(size=2048, seed=0):
+    rng = np.random.default_rng(seed)
+    mndwi = rng.uniform(-1, 1, (size, size)).astype(np.float32)
+    mndwi[rng.random((size, size)) < 0.1] = np.nan
+    return mndwi
+
+
+# The chained .where(gte().And(lt())) cascade classify_mndwi used to build, replayed with NumPy:
+# one full scan of the image per class
+def classify_cascade(masked_image, classes=MNDWI_CLASSES):
+    classified = np.array(masked_image, copy=True)
+    for lower, upper, value in classes:
+        classified = np.where((masked_image >= lower) & (masked_image < upper), value, classified)
+    return classified
+
+
+# Earth Engine client for the benchmarks building expressions: replayed from MNDWI_EE_REPLAY when set (see offline.py),
+# otherwise the local credentials. Initialized once, benchmarks print why they are skipped when it fails.
+_ee_client = {}
+
+
+def ee_ready(name):
+    if not _ee_client:
+        try:
+            offline.initialize()
+            _ee_client['error'] = None
+        except Exception as error:
+            _ee_client['error'] = error
+    if _ee_client['error'] is not None:
+        print(f"{name} skipped: Earth Engine not initialized ({_ee_client['error']})")
+    return _ee_client['error'] is None
+
+
+# Per pixel cost of the lookup table classifier next to the chained cascade
+def bench_classify(size=2048):
+    backend = get_backend("numpy")
+    mndwi = synthetic_mndwi(size)
+    pixels = mndwi.size
+    cascade = timeit(lambda: classify_cascade(mndwi))
+    lut = timeit(lambda: backend.classify(mndwi))
+    print(f"classify ({size}x{size}, {len(MNDWI_CLASSES)} classes)")
+    print(f"  chained cascade : {cascade * 1e9 / pixels:6.2f} ns/pixel")
+    print(f"  lookup table    : {lut * 1e9 / pixels:6.2f} ns/pixel  ({cascade / lut:.1f}x)")
+    return {'cascade_ns_per_pixel': cascade * 1e9 / pixels, 'lut_ns_per_pixel': lut * 1e9 / pixels}
+
+
+# Stand-in for an ee.Image: getMapId blocks for a fixed network latency
+class StubImage:
+    def __init__(self, name, latency=0.2):
+        self.name = name
+        self.latency = latency
+
+    def serialize(self):
+        return self.name
+
+    def getMapId(self, vis_params):
+        time.sleep(self.latency)
+        return {'tile_fetcher': SimpleNamespace(url_format=f"https://tiles.invalid/{self.name}/{{z}}/{{x}}/{{y}}")}
+
+
+# Chunked processing of a raster written to disk as two uint16 band files (size x size, generated row block by row
+# block so the benchmark itself never holds a full band): throughput and memory growth for a small memory budget
+def bench_raster(size=4096, memory_budget=32 << 20, seed=0):
+    rng = np.random.default_rng(seed)
+    with tempfile.TemporaryDirectory() as directory:
+        paths = {band: os.path.join(directory, f"{band}.npy") for band in ('B3', 'B11')}
+        for path in paths.values():
+            with raster.open_npy_writer(path, (size, size), np.uint16) as band_file:
+                for _ in range(0, size, 256):
+                    rng.integers(0, 10000, (min(256, size), size), dtype=np.uint16).tofile(band_file)
+        report = raster.process_raster(paths['B3'], paths['B11'], os.path.join(directory, 'output'), memory_budget=memory_budget)
+    band_mb = size * size * 2 / 2 ** 20
+    print(f"raster ({size}x{size}, {band_mb:.0f} MB per band, {memory_budget >> 20} MB budget: {report['chunks']} windows of {report['chunk_rows']} rows)")
+    print(f"  throughput : {report['megapixels_per_second']:8.1f} Mpixel/s  ({report['seconds'] * 1e9 / size ** 2:.2f} ns/pixel)")
+    print(f"  peak RSS   : {report['peak_rss_mb']:8.1f} MB  (+{report['rss_growth_mb']:.1f} MB during the run)")
+    return {'ns_per_pixel': report['seconds'] * 1e9 / size ** 2, 'rss_growth_mb': report['rss_growth_mb']}
+
+
+# Scaling of the shared memory pool (see raster.py) on a size x size window already in shared memory, from 1 worker
+# to the cores available, next to the same computation in this process. Ideal scaling: n workers n times faster.
+def bench_parallel(size=4096, repeat=3, seed=0):
+    rng = np.random.default_rng(seed)
+    backend = get_backend("numpy")
+    green = rng.integers(0, 10000, (size, size), dtype=np.uint16)
+    swir = rng.integers(0, 10000, (size, size), dtype=np.uint16)
+    pixels = size * size
+    serial = timeit(lambda: raster.mndwi_window(backend, green, swir), repeat=repeat)
+    counts = sorted({min(2 ** power, raster.PARALLEL_WORKERS) for power in range(raster.PARALLEL_WORKERS.bit_length() + 1)})
+    print(f"parallel ({size}x{size}, {raster.PARALLEL_WORKERS} core(s) available)")
+    print(f"  in process  : {serial * 1e9 / pixels:6.2f} ns/pixel")
+    metrics = {'serial_ns_per_pixel': serial * 1e9 / pixels}
+    single = None
+    for workers in counts:
+        with raster.SharedMndwiPool((size, size), [green.dtype, swir.dtype], workers=workers) as pool:
+            pool.green[:], pool.swir[:] = green, swir
+            # the first run starts the worker processes
+            pool.run()
+            elapsed = timeit(pool.run, repeat=repeat)
+        single = single or elapsed
+        print(f"  {workers:2d} worker(s): {elapsed * 1e9 / pixels:6.2f} ns/pixel  ({single / elapsed:.2f}x, {single / elapsed / workers:.0%} efficiency)")
+        metrics[f'workers_{workers}_ns_per_pixel'] = elapsed * 1e9 / pixels
+    if raster.PARALLEL_WORKERS == 1:
+        print("  (a single core is available here: no scaling to measure)")
+    return metrics
+
+
+# Six layers of the two-date view, requested one after another and concurrently (tile url cache disabled)
+def bench_layers(count=6, latency=0.2):
+    images = [(StubImage(f"layer-{index}", latency), {'min': 0, 'max': 1}) for index in range(count)]
+
+    def sequential():
+        layers.tile_url_cache.clear()
+        return [layers.map_tile_url(image, vis_params) for image, vis_params in images]
+
+    # what the app does: layer stages run on the shared map id executor, urls kept in order
+    def concurrent():
+        layers.tile_url_cache.clear()
+        return context_map(layers.map_id_executor, lambda layer: layers.map_tile_url(*layer), images)
+
+    assert sequential() == concurrent()
+    sequential_time = timeit(sequential, repeat=2)
+    concurrent_time = timeit(concurrent, repeat=2)
+    print(f"layers ({count} layers, {latency * 1000:.0f} ms getMapId latency)")
+    print(f"  sequential : {sequential_time * 1000:7.1f} ms")
+    print(f"  concurrent : {concurrent_time * 1000:7.1f} ms  ({sequential_time / concurrent_time:.1f}x)")
+    return {'sequential_s': sequential_time, 'concurrent_s': concurrent_time}
+
+
+# Sessions opening the same layer at the same time: identical getMapId requests in flight are coalesced
+def bench_coalesce(sessions=20, latency=0.2):
+    image = StubImage("shared-layer", latency)
+    calls = []
+    get_map_id = image.getMapId
+    image.getMapId = lambda vis_params: calls.append(vis_params) or get_map_id(vis_params)
+    layers.tile_url_cache.clear()
+    with ThreadPoolExecutor(max_workers=sessions) as executor:
+        start = time.perf_counter()
+        urls = set(executor.map(lambda _: layers.map_tile_url(image, {'min': 0, 'max': 1}), range(sessions)))
+        elapsed = time.perf_counter() - start
+    assert len(urls) == 1
+    print(f"coalesce ({sessions} sessions, {latency * 1000:.0f} ms getMapId latency)")
+    print(f"  getMapId calls : {len(calls)}  ({elapsed * 1000:.1f} ms)")
+    print(f"  tile url cache : {layers.tile_url_cache.stats()}")
+    return {'coalesced_s': elapsed, 'get_map_id_calls': len(calls)}
+
+
+# Fake Earth Engine call: blocks for a fixed latency and fails with a throttling error a share of the time.
+# Records the highest number of calls running at once.
+class ThrottledClient:
+    def __init__(self, latency=0.02, error_rate=0.3, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.running = 0
+        self.max_running = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def call(self, name):
+        with self._lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            throttled = self.random.random() < self.error_rate
+            self.errors += throttled
+        try:
+            time.sleep(self.latency)
+            if throttled:
+                raise ee.EEException("Too Many Requests: Request was rejected because the request rate or concurrency limit was exceeded.")
+            return name, time.perf_counter()
+        finally:
+            with self._lock:
+                self.running -= 1
+
+
+# Scheduler self-check against the throttling fake client: every call succeeds through retries, the concurrency cap
+# holds, and interactive calls queued behind background ones still finish first
+def bench_scheduler(background=60, interactive=10, max_concurrent=4):
+    client = ThrottledClient()
+    scheduler = RequestScheduler(max_concurrent=max_concurrent, rate=200, burst=max_concurrent, backoff_base=0.01, backoff_max=0.1)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=background + interactive) as executor:
+        background_calls = [executor.submit(scheduler.call, client.call, 'background', priority=BACKGROUND) for _ in range(background)]
+        time.sleep(0.05)
+        interactive_calls = [executor.submit(scheduler.call, client.call, 'interactive', priority=INTERACTIVE) for _ in range(interactive)]
+        background_done = [call.result()[1] - start for call in background_calls]
+        interactive_done = [call.result()[1] - start for call in interactive_calls]
+    assert client.max_running <= max_concurrent
+    assert max(interactive_done) < max(background_done)
+    stats = scheduler.stats()
+    print(f"scheduler ({background} background + {interactive} interactive calls, {client.error_rate:.0%} throttled, cap {max_concurrent})")
+    print(f"  throttling errors : {client.errors}, retried {stats['retries']}, failed {stats['failures']}")
+    print(f"  max concurrency   : {client.max_running}")
+    print(f"  interactive done  : {np.mean(interactive_done) * 1000:7.1f} ms mean, background {np.mean(background_done) * 1000:7.1f} ms mean")
+    return {'interactive_mean_s': float(np.mean(interactive_done)), 'background_mean_s': float(np.mean(background_done))}
+
+
+# Synthetic FeatureCollection of square polygons with the given number of vertices each, as bytes
+def synthetic_geojson(features=5000, vertices=64, seed=0):
+    rng = np.random.default_rng(seed)
+    angles = np.linspace(0, 2 * np.pi, vertices)
+    collection = {'type': 'FeatureCollection', 'features': []}
+    for index, (lon, lat) in enumerate(rng.uniform([-180, -80], [170, 70], (features, 2))):
+        ring = np.column_stack([lon + np.cos(angles), lat + np.sin(angles)]).round(6).tolist()
+        collection['features'].append({'type': 'Feature', 'properties': {'id': index}, 'geometry': {'type': 'Polygon', 'coordinates': [ring]}})
+    return json.dumps(collection).encode('utf-8')
+
+
+# Streaming GeoJSON reader throughput
+def bench_geojson(features=5000):
+    data = synthetic_geojson(features)
+    stream = GeoJSONFeatureStream(io.BytesIO(data))
+    assert sum(1 for _ in stream) == features
+    print(f"geojson ({features} features, {len(data) / 1e6:.1f} MB)")
+    print(f"  streaming reader : {stream.throughput:10,.0f} features/s")
+    return {'s_per_1000_features': 1000 / stream.throughput}
+
+
+# AOI upload processing of a large file, as parse_aoi_file does it minus the ee.Geometry wrappers: streaming the
+# features, simplifying them to the output scale, bounds and centroids
+def bench_upload(features=500, vertices=256, scale=SENTINEL2['scale']):
+    data = synthetic_geojson(features, vertices)
+
+    def process():
+        for feature in GeoJSONFeatureStream(io.BytesIO(data)):
+            geometry_type, coordinates = feature['geometry']['type'], feature['geometry']['coordinates']
+            simplify_geometry(geometry_type, coordinates, simplify_tolerance(scale))
+            geometry_bounds(geometry_type, coordinates)
+            geometry_centroid(geometry_type, coordinates)
+    elapsed = timeit(process, repeat=3)
+    print(f"upload ({features} features x {vertices} vertices, {len(data) / 1e6:.1f} MB, simplified at {scale} m)")
+    print(f"  parse + simplify + bounds + centroid : {elapsed * 1000:8.1f} ms  ({features / elapsed:,.0f} features/s)")
+    return {'upload_s': elapsed}
+
+
+# Client side cost of building (and serializing) the expressions of one date, for each compositing mode:
+# collection, composite, mndwi, mask and classification
+def bench_expressions(repeat=20):
+    if not ee_ready("expressions"):
+        return None
+    backend = get_backend("ee")
+    aoi = ee.Geometry.Polygon([[[10.0, 36.0], [10.5, 36.0], [10.5, 36.5], [10.0, 36.5], [10.0, 36.0]]])
+    metrics = {}
+    print(f"expressions (one date, best of {repeat})")
+    for mode in COMPOSITE_MODES:
+        def build():
+            scenes = composite_scenes(SENTINEL2, sat_collection(SENTINEL2, 85, '2023-10-01', '2023-10-08', aoi), mode, DEFAULT_SCENE_LIMIT)
+            mndwi = backend.normalized_difference(sat_composite(SENTINEL2, scenes, aoi, mode), SENTINEL2['mndwi_bands'])
+            return backend.classify(backend.mask(mndwi), SENTINEL2['mndwi_classes']).serialize()
+        elapsed = timeit(build, repeat=repeat)
+        print(f"  {mode:15s}: {elapsed * 1000:6.2f} ms  ({len(build()):6d} bytes)")
+        metrics[f'{mode}_build_s'] = elapsed
+    return metrics
+
+
+# satCollection as app.py used to build it: every band of every image clipped and scaled, then the median
+def legacy_composite(cloud_rate, start_date, end_date, aoi):
+    collection = ee.ImageCollection(SENTINEL2['collection']) \
+        .filter(ee.Filter.lt("CLOUDY_PIXEL_PERCENTAGE", cloud_rate)) \
+        .filterDate(start_date, end_date) \
+        .filterBounds(aoi)
+    return collection.map(lambda image: image.clip(aoi).divide(10000)).median()
+
+
+# Serialized expression graph size of the composite, before and after the band selection / clip pushdown.
+# Building EE expressions needs an initialized Earth Engine client (skipped otherwise).
+def bench_collection_graph():
+    if not ee_ready("collection_graph"):
+        return None
+    aoi = ee.Geometry.Polygon([[[10.0, 36.0], [10.5, 36.0], [10.5, 36.5], [10.0, 36.5], [10.0, 36.0]]])
+    legacy = len(legacy_composite(85, '2023-10-01', '2023-10-08', aoi).serialize())
+    pushed_down = len(sat_composite(SENTINEL2, sat_collection(SENTINEL2, 85, '2023-10-01', '2023-10-08', aoi), aoi).serialize())
+    print("collection_graph (serialized composite expression)")
+    print(f"  per image clip + scale : {legacy:6d} bytes")
+    print(f"  select + composite clip: {pushed_down:6d} bytes")
+    return {'legacy_bytes': legacy, 'pushed_down_bytes': pushed_down}
+
+
+# End to end batch pipeline (collections, composites, statistics, map ids) replayed from a recorded cassette, no
+# network needed. Record once with: MNDWI_EE_RECORD=run.jsonl python batch.py aois --dates 2023-10-08 --output out
+# then: MNDWI_EE_REPLAY=run.jsonl MNDWI_BENCH_ARGS="aois --dates 2023-10-08" python benchmark.py replay
+# (MNDWI_EE_LATENCY=0.2 replays every response after 200 ms, like a real round trip)
+def bench_replay():
+    if not os.environ.get('MNDWI_EE_REPLAY') or not os.environ.get('MNDWI_BENCH_ARGS'):
+        print("replay skipped: set MNDWI_EE_REPLAY (cassette) and MNDWI_BENCH_ARGS (batch.py arguments)")
+        return None
+    with tempfile.TemporaryDirectory() as output:
+        start = time.perf_counter()
+        status = batch.main(shlex.split(os.environ['MNDWI_BENCH_ARGS']) + ['--output', output])
+        elapsed = time.perf_counter() - start
+    print(f"replay ({os.environ['MNDWI_BENCH_ARGS']}, {float(os.environ.get('MNDWI_EE_LATENCY', 0)) * 1000:.0f} ms latency)")
+    print(f"  end to end : {elapsed * 1000:8.1f} ms{'' if status == 0 else '  (some jobs failed)'}")
+    return {'end_to_end_s': elapsed} if status == 0 else None
+
+
+# Cold start of a fresh process: importing the pipeline modules the app imports at startup (Streamlit and the map
+# modules aside, they are not needed here), best of a few processes
+def bench_startup(repeat=3, modules=('aoi', 'layers', 'stages', 'collection', 'offline', 'zonal', 'timeseries', 'tracing')):
+    code = f"import time; start = time.perf_counter(); import {', '.join(modules)}; print(time.perf_counter() - start)"
+    imports = min(float(subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout) for _ in range(repeat))
+    print(f"startup (fresh process, best of {repeat})")
+    print(f"  pipeline imports : {imports * 1000:8.1f} ms")
+    return {'imports_s': imports}
+
+
+# Full render of the app (main() top to bottom, then a rerun with unchanged inputs) through Streamlit's AppTest,
+# with Earth Engine replayed from a cassette recorded while using the app (MNDWI_EE_RECORD=app.jsonl streamlit run app.py)
+def bench_render(app_file="app.py"):
+    try:
+        from streamlit.testing.v1 import AppTest
+    except ImportError:
+        print("render skipped: streamlit.testing not available (Streamlit >= 1.28)")
+        return None
+    if not os.environ.get('MNDWI_EE_REPLAY'):
+        print("render skipped: set MNDWI_EE_REPLAY (cassette recorded with the app)")
+        return None
+    app = AppTest.from_file(app_file, default_timeout=600)
+    first = timeit(app.run, repeat=1)
+    rerun = timeit(app.run, repeat=3)
+    if app.exception:
+        print(f"render failed: {app.exception[0].message}")
+        return None
+    print(f"render ({app_file})")
+    print(f"  first run : {first * 1000:8.1f} ms")
+    print(f"  rerun     : {rerun * 1000:8.1f} ms")
+    return {'first_run_s': first, 'rerun_s': rerun}
+
+
+BENCHMARKS = {
+    "classify": bench_classify,
+    "raster": bench_raster,
+    "parallel": bench_parallel,
+    "layers": bench_layers,
+    "coalesce": bench_coalesce,
+    "scheduler": bench_scheduler,
+    "geojson": bench_geojson,
+    "upload": bench_upload,
+    "expressions": bench_expressions,
+    "collection_graph": bench_collection_graph,
+    "replay": bench_replay,
+    "startup": bench_startup,
+    "render": bench_render,
+}
+
+# Regression threshold in percent of the baseline value
+DEFAULT_THRESHOLD = 25
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for the mndwi pipeline.")
+    parser.add_argument('names', nargs='*', metavar='name', help=f"benchmarks to run ({', '.join(BENCHMARKS)}), all by default")
+    parser.add_argument('--save', help="write the metrics of this run as a JSON baseline")
+    parser.add_argument('--baseline', help="JSON baseline to compare this run to")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help=f"regression threshold in percent (default: {DEFAULT_THRESHOLD})")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+    return args
+
+
+# Metrics of the run that are more than threshold percent above their baseline: [(benchmark, metric, baseline, value, change)]
+def regressions(metrics, baseline, threshold):
+    found = []
+    for name, values in metrics.items():
+        for metric, value in values.items():
+            reference = baseline.get(name, {}).get(metric)
+            if reference:
+                change = (value - reference) / reference * 100
+                if change > threshold:
+                    found.append((name, metric, reference, value, change))
+    return found
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    metrics = {}
+    for name in args.names or BENCHMARKS:
+        result = BENCHMARKS[name]()
+        if result is not None:
+            metrics[name] = result
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as baseline_file:
+            json.dump({'python': platform.python_version(), 'machine': platform.platform(), 'metrics': metrics}, baseline_file, indent=2)
+        print(f"baseline written to {args.save}")
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)['metrics']
+        found = regressions(metrics, baseline, args.threshold)
+        for name, metric, reference, value, change in found:
+            print(f"REGRESSION {name}.{metric}: {reference:.6g} -> {value:.6g} (+{change:.0f}%, threshold {args.threshold:g}%)")
+        print(f"{len(found)} regression(s) against {args.baseline}")
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
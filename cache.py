@@ -0,0 +1,123 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+#### Process-wide caches
+# Streamlit reruns main() top to bottom on every interaction, but imported modules live as long as the server
+# process: a cache kept at module level is shared by every rerun and every session.
+
+
+# Stable key of an Earth Engine object: hash of its serialized expression plus any extra parameters
+def expression_key(ee_object, *extras):
+    digest = hashlib.sha256(ee_object.serialize().encode('utf-8'))
+    for extra in extras:
+        digest.update(json.dumps(extra, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+
+# Size of a value in bytes, estimated from its JSON serialization (tile urls, getInfo results)
+def json_size(value):
+    return len(json.dumps(value, default=str))
+
+
+# Marker of a missing entry (None is a valid cached value)
+_MISSING = object()
+
+
+# Thread safe LRU cache where entries also expire after ttl seconds (never when ttl is None).
+# With max_bytes, entries are also evicted (least recently used first) to keep the total of sizeof(value) under it.
+# get_or_compute coalesces concurrent misses of the same key (single flight): the first caller computes the value,
+# the others wait for it instead of computing it again. Hits, misses and coalesced calls are counted.
+class TTLCache:
+    def __init__(self, maxsize=256, ttl=3600, max_bytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or json_size
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    # Entry value, or _MISSING when absent or expired (lock held)
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return _MISSING
+        value, expires, size = entry
+        if expires <= time.monotonic():
+            del self._entries[key]
+            self.bytes -= size
+            return _MISSING
+        self._entries.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._lookup(key)
+            return default if value is _MISSING else value
+
+    def set(self, key, value):
+        with self._lock:
+            self._set(key, value)
+
+    def _set(self, key, value):
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.bytes -= previous[2]
+        self._entries[key] = (value, time.monotonic() + self.ttl if self.ttl is not None else float('inf'), size)
+        self.bytes += size
+        while len(self._entries) > self.maxsize or (self.max_bytes is not None and self.bytes > self.max_bytes and len(self._entries) > 1):
+            _, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self.bytes -= evicted_size
+
+    # Cached value of key, computing it with compute() on a miss, once for all the concurrent callers.
+    # An error of compute() is raised to every waiting caller and nothing is cached.
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            value = self._lookup(key)
+            if value is not _MISSING:
+                self.hits += 1
+                return value
+            leading = False
+            flight = self._in_flight.get(key)
+            if flight is not None:
+                self.coalesced += 1
+            else:
+                self.misses += 1
+                flight = self._in_flight[key] = Future()
+                leading = True
+        if not leading:
+            return flight.result()
+        try:
+            value = compute()
+        except BaseException as error:
+            with self._lock:
+                del self._in_flight[key]
+            flight.set_exception(error)
+            raise
+        with self._lock:
+            self._set(key, value)
+            del self._in_flight[key]
+        flight.set_result(value)
+        return value
+
+    # {'entries', 'bytes', 'hits', 'misses', 'coalesced'}
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,89 @@
+import ee
+from datetime import timedelta
+from engine import MNDWI_BANDS, LANDSAT_MNDWI_BANDS, MNDWI_CLASSES, LANDSAT_MNDWI_CLASSES
+
+#### Satellite image collections
+# Only the bands used downstream are selected up front, and the reflectance scaling and the clip to the area
+# of interest are applied once on the composite instead of on every image of the collection.
+# The number of scenes reduced into a composite can be bounded with the compositing modes.
+
+# Sentinel-2 surface reflectance (app.py)
+SENTINEL2 = {
+    'collection': 'COPERNICUS/S2_SR',
+    # TCI (B4, B3, B2) and mndwi (B3, B11) bands
+    'bands': ['B2', 'B3', 'B4', 'B11'],
+    'mndwi_bands': MNDWI_BANDS,
+    'mndwi_classes': MNDWI_CLASSES,
+    'cloud_property': 'CLOUDY_PIXEL_PERCENTAGE',
+    # output scale in meters
+    'scale': 10,
+}
+
+# Landsat 8 (app2.py)
+LANDSAT8 = {
+    'collection': 'LANDSAT/LC08/C02/T1',
+    # TCI (B4, B3, B2) and mndwi (B3, B6) bands
+    'bands': ['B2', 'B3', 'B4', 'B6'],
+    'mndwi_bands': LANDSAT_MNDWI_BANDS,
+    'mndwi_classes': LANDSAT_MNDWI_CLASSES,
+    'cloud_property': 'CLOUDY_PIXEL_PERCENTAGE',
+    'scale': 30,
+}
+
+# Stored band values are reflectance * 10000
+REFLECTANCE_SCALE = 10000
+
+# Compositing modes, from the best quality to the cheapest to render
+COMPOSITE_MODES = {
+    'median': "Median of all scenes",
+    'least_cloudy': "Median of the N least cloudy scenes",
+    'mosaic': "Most recent scenes on top (mosaic)",
+    'quality_mosaic': "Highest mndwi pixel (quality mosaic)",
+}
+# Default number of scenes of the 'least_cloudy' mode
+DEFAULT_SCENE_LIMIT = 5
+
+# Sensors by name (batch runner)
+SENSORS = {
+    'sentinel2': SENTINEL2,
+    'landsat8': LANDSAT8,
+}
+
+
+# Date range of time_range days leading to a date, as 'YYYY-MM-DD' strings (start, end)
+def date_window(end_date, time_range=7):
+    start_date = end_date - timedelta(days=time_range)
+    return start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')
+
+
+# Defining a function to create and filter a GEE image collection for results
+def sat_collection(sensor, cloud_rate, start_date, end_date, aoi):
+    return ee.ImageCollection(sensor['collection']) \
+        .filter(ee.Filter.lt(sensor['cloud_property'], cloud_rate)) \
+        .filterDate(start_date, end_date) \
+        .filterBounds(aoi) \
+        .select(sensor['bands'])
+
+
+# Scenes of a collection that go into the composite: all of them, or the scene_limit least cloudy ones
+def composite_scenes(sensor, collection, mode='median', scene_limit=DEFAULT_SCENE_LIMIT):
+    if mode == 'least_cloudy':
+        return collection.sort(sensor['cloud_property']).limit(scene_limit)
+    return collection
+
+
+# Composite of the scenes, scaled to reflectance and clipped to the area of interest.
+# Scaling by a constant and clipping give the same pixels before or after compositing, done here they run once.
+def sat_composite(sensor, scenes, aoi, mode='median'):
+    if mode not in COMPOSITE_MODES:
+        raise ValueError(f"Unknown compositing mode: {mode!r} (available: {', '.join(COMPOSITE_MODES)})")
+    if mode == 'mosaic':
+        # mosaic() puts the last image on top: sorting by date keeps the most recent pixels
+        composite = scenes.sort('system:time_start').mosaic()
+    elif mode == 'quality_mosaic':
+        # each pixel comes from the scene where its mndwi is the highest (the wettest observation)
+        with_mndwi = scenes.map(lambda image: image.addBands(image.normalizedDifference(sensor['mndwi_bands']).rename('quality')))
+        composite = with_mndwi.qualityMosaic('quality').select(sensor['bands'])
+    else:
+        composite = scenes.median()
+    return composite.divide(REFLECTANCE_SCALE).clip(aoi)
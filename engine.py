@@ -0,0 +1,178 @@
+import ee
+import numpy as np
+
+#### Compute backends for the MNDWI pipeline
+# The pipeline is made of three steps: normalized difference, water/land mask and classification.
+# Each backend implements those steps on its own image type:
+#   - EarthEngineBackend works on ee.Image objects and only builds server-side expressions
+#   - NumpyBackend works on in-memory band arrays ({"B3": ndarray, "B11": ndarray, ...}) and computes right away
+# Masked pixels are represented as NaN on the NumPy side, unclassified pixels as CLASS_NODATA.
+
+# Bands used to compute mndwi: Green & SWIR
+# Sentinel-2 (app.py)
+MNDWI_BANDS = ['B3', 'B11']
+# Landsat 8 (app2.py)
+LANDSAT_MNDWI_BANDS = ['B3', 'B6']
+
+# mndwi classes as (lower bound inclusive, upper bound exclusive, class value)
+# When classes overlap the last one wins, like the chained .where() it replaces.
+# Values falling in none of the classes (gaps) are left unclassified.
+# Sentinel-2 (app.py)
+MNDWI_CLASSES = [
+    (-1, -0.1, 1),
+    (0, 0.2, 2),
+    (0.21, 0.35, 3),
+    (0.35, 0.45, 4),
+    (0.45, 0.65, 5),
+]
+# Landsat 8 (app2.py)
+LANDSAT_MNDWI_CLASSES = [
+    (0, 0.15, 1),
+    (0.15, 0.25, 2),
+    (0.25, 0.35, 3),
+    (0.35, 0.45, 4),
+    (0.45, 0.65, 5),
+    (0.65, 0.75, 6),
+    (0.75, float('inf'), 7),
+]
+
+# Class value of unclassified pixels in local rasters
+CLASS_NODATA = 0
+
+# Class transitions between two dates are encoded as from * TRANSITION_FACTOR + to in a uint8 band
+# (e.g. 25: class 2 -> class 5), pixels unclassified on either date have no transition
+TRANSITION_FACTOR = 10
+# Colours of the transition band: unchanged class, then wetter (higher class) / drier (lower class) by the number of
+# classes crossed: 1, 2, 3 or more
+TRANSITION_UNCHANGED = "#f0f0f0"
+TRANSITION_WETTER = ["#9ecae1", "#4292c6", "#08519c"]
+TRANSITION_DRIER = ["#fdae6b", "#f16913", "#a63603"]
+
+
+# Visual parameters of the transition band: one palette entry per code from the lowest to the highest transition,
+# so every code is drawn with the colour of its own direction and size (codes matching no pair of classes are unused)
+def transition_vis_params(classes, unchanged=TRANSITION_UNCHANGED, wetter=TRANSITION_WETTER, drier=TRANSITION_DRIER):
+    values = sorted({value for _, _, value in classes})
+    lowest, highest = values[0] * TRANSITION_FACTOR + values[0], values[-1] * TRANSITION_FACTOR + values[-1]
+    palette = []
+    for code in range(lowest, highest + 1):
+        initial, updated = divmod(code, TRANSITION_FACTOR)
+        steps = values.index(updated) - values.index(initial) if initial in values and updated in values else 0
+        palette.append(unchanged if steps == 0 else (wetter if steps > 0 else drier)[min(abs(steps), len(wetter)) - 1])
+    return {'bands': ['transition'], 'min': lowest, 'max': highest, 'palette': palette}
+
+
+# Turning a class table into lookup data:
+# edges are the sorted finite bounds, the lookup table gives the class value of every interval between
+# two consecutive edges (interval i covers edges[i-1] <= x < edges[i], with open ends on both sides)
+def class_lookup_table(classes):
+    edges = sorted({bound for lower, upper, _ in classes for bound in (lower, upper) if np.isfinite(bound)})
+    bounds = [-np.inf] + edges + [np.inf]
+    lut = []
+    for interval_lower, interval_upper in zip(bounds[:-1], bounds[1:]):
+        value = CLASS_NODATA
+        for lower, upper, class_value in classes:
+            if lower <= interval_lower and interval_upper <= upper:
+                value = class_value
+        lut.append(value)
+    return edges, lut
+
+
+# Earth Engine backend: builds the same expressions the app always used
+class EarthEngineBackend:
+    name = "ee"
+
+    def normalized_difference(self, image, bands=MNDWI_BANDS):
+        return image.normalizedDifference(bands)
+
+    # Masking mndwi over the water & show only land
+    def mask(self, image):
+        return image.updateMask(image.gte(0))
+
+    # Single pass classification: one expression finds the interval of each pixel, remap turns intervals
+    # into class values and masks the intervals that belong to no class
+    def classify(self, masked_image, classes=MNDWI_CLASSES):
+        edges, lut = class_lookup_table(classes)
+        interval = str(len(edges))
+        for index in reversed(range(len(edges))):
+            interval = f"b(0) < {edges[index]!r} ? {index} : ({interval})"
+        intervals = ee.Image(masked_image).expression(interval)
+        classified_intervals = [index for index, value in enumerate(lut) if value != CLASS_NODATA]
+        return intervals.remap(classified_intervals, [lut[index] for index in classified_intervals])
+
+    # Change between two dates as one image: mndwi difference and class transition bands
+    def change(self, initial_mndwi, updated_mndwi, initial_classified, updated_classified):
+        return ee.Image.cat([
+            updated_mndwi.subtract(initial_mndwi).rename('mndwi_change'),
+            initial_classified.multiply(TRANSITION_FACTOR).add(updated_classified).toUint8().rename('transition'),
+        ])
+
+
+# NumPy backend: vectorized version of the same steps for local rasters
+class NumpyBackend:
+    name = "numpy"
+
+    def normalized_difference(self, image, bands=MNDWI_BANDS):
+        first = np.asarray(image[bands[0]], dtype=np.float32)
+        second = np.asarray(image[bands[1]], dtype=np.float32)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            difference = (first - second) / (first + second)
+        # a zero denominator has no defined index, EE leaves those pixels masked too
+        difference[~np.isfinite(difference)] = np.nan
+        return difference
+
+    def mask(self, image):
+        # NaN >= 0 is False, so already masked pixels stay masked
+        return np.where(image >= 0, image, np.nan).astype(np.float32, copy=False)
+
+    # Single pass classification: the interval of each pixel is the number of edges it is >= to (what np.digitize
+    # returns, without its per pixel binary search), the lookup table then gives its class.
+    # The raster is walked in blocks small enough to stay in cache, so memory is only read once.
+    def classify(self, masked_image, classes=MNDWI_CLASSES, block_size=1 << 16):
+        edges, lut = class_lookup_table(classes)
+        edges = np.asarray(edges, dtype=np.float32)
+        lut = np.asarray(lut, dtype=np.uint8)
+        masked_image = np.asarray(masked_image, dtype=np.float32)
+        pixels = masked_image.reshape(-1)
+        classified = np.empty(pixels.size, dtype=np.uint8)
+        intervals = np.empty(block_size, dtype=np.uint8)
+        passed = np.empty(block_size, dtype=bool)
+        for start in range(0, pixels.size, block_size):
+            block = pixels[start:start + block_size]
+            block_intervals = intervals[:block.size]
+            block_passed = passed[:block.size]
+            block_intervals[:] = 0
+            for edge in edges:
+                np.greater_equal(block, edge, out=block_passed)
+                block_intervals += block_passed
+            np.take(lut, block_intervals, out=classified[start:start + block.size])
+        classified = classified.reshape(masked_image.shape)
+        # NaN (masked) pixels compare False with every edge and land in the first interval
+        if lut[0] != CLASS_NODATA:
+            classified[np.isnan(masked_image)] = CLASS_NODATA
+        return classified
+
+    # Change between two dates: {'mndwi_change': float32 difference, 'transition': uint8 from * 10 + to}
+    def change(self, initial_mndwi, updated_mndwi, initial_classified, updated_classified):
+        initial_classified = np.asarray(initial_classified, dtype=np.uint8)
+        updated_classified = np.asarray(updated_classified, dtype=np.uint8)
+        transition = initial_classified * np.uint8(TRANSITION_FACTOR) + updated_classified
+        transition[(initial_classified == CLASS_NODATA) | (updated_classified == CLASS_NODATA)] = CLASS_NODATA
+        return {
+            'mndwi_change': np.subtract(updated_mndwi, initial_mndwi, dtype=np.float32),
+            'transition': transition,
+        }
+
+
+BACKENDS = {
+    EarthEngineBackend.name: EarthEngineBackend,
+    NumpyBackend.name: NumpyBackend,
+}
+
+
+# Returning a backend instance by name ("ee" or "numpy")
+def get_backend(name="ee"):
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown compute backend: {name!r} (available: {', '.join(BACKENDS)})") from None
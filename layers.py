@@ -0,0 +1,51 @@
+from concurrent.futures import ThreadPoolExecutor
+from cache import TTLCache, expression_key
+from scheduler import ee_scheduler, INTERACTIVE, BACKGROUND
+from tracing import traced_request
+
+#### Earth Engine map layers & results shared by every session
+# Identical requests are common (many users opening the app on the same dates during a flood event): tile urls and
+# getInfo results are cached process-wide by expression hash, and identical requests in flight at the same time
+# are coalesced, only the first one goes to Earth Engine (see cache.TTLCache.get_or_compute).
+# The requests that do go out are run by the Earth Engine scheduler (see scheduler.py): map layers first.
+
+# Map ids returned by getMapId stay valid for a few hours: refreshing them after one hour keeps a safe margin
+MAP_ID_TTL = 60 * 60
+MAP_ID_CACHE_SIZE = 256
+
+# getInfo results (scene counts, statistics): one hour like the layers, within 64 MB of JSON
+INFO_TTL = 60 * 60
+INFO_CACHE_SIZE = 1024
+INFO_CACHE_BYTES = 64 << 20
+
+# Maximum number of getMapId calls running at the same time, for the whole process
+MAP_ID_WORKERS = 6
+# Maximum number of statistics stages (zonal statistics, minutes long for large AOIs) running at the same time
+STATISTICS_WORKERS = 4
+
+# Tile urls of the layers already requested, keyed by expression + visual parameters
+tile_url_cache = TTLCache(maxsize=MAP_ID_CACHE_SIZE, ttl=MAP_ID_TTL)
+# getInfo results keyed by expression
+info_cache = TTLCache(maxsize=INFO_CACHE_SIZE, ttl=INFO_TTL, max_bytes=INFO_CACHE_BYTES)
+# Shared by every session so the number of concurrent requests stays bounded
+map_id_executor = ThreadPoolExecutor(max_workers=MAP_ID_WORKERS, thread_name_prefix="ee-map-id")
+# Statistics run on their own threads: slow statistics of some sessions never hold up the map layers of others
+statistics_executor = ThreadPoolExecutor(max_workers=STATISTICS_WORKERS, thread_name_prefix="ee-statistics")
+
+
+# Getting the tile url of an image, only calling getMapId when the same image/vis params were not requested lately
+def map_tile_url(ee_image_object, vis_params):
+    return tile_url_cache.get_or_compute(
+        expression_key(ee_image_object, vis_params),
+        lambda: traced_request('getMapId', ee_image_object, lambda: ee_scheduler.call(ee_image_object.getMapId, vis_params, priority=INTERACTIVE)['tile_fetcher'].url_format))
+
+
+# getInfo() of an Earth Engine object, only requested when the same expression was not requested lately
+# (statistics are background requests by default, shown after the map)
+def get_info(ee_object, priority=BACKGROUND):
+    return info_cache.get_or_compute(expression_key(ee_object), lambda: traced_request('getInfo', ee_object, lambda: ee_scheduler.call(ee_object.getInfo, priority=priority)))
+
+
+# Hit/miss/coalesce counters of the shared caches
+def shared_cache_stats():
+    return {'tile urls': tile_url_cache.stats(), 'getInfo': info_cache.stats()}
@@ -0,0 +1,155 @@
+import base64
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import ee
+import httplib2
+from scheduler import ee_scheduler
+from tracing import record_startup
+
+#### Offline Earth Engine client: record / replay
+# Earth Engine requests are plain HTTP calls made through the transport given to ee.Initialize(http_transport=...),
+# including the API discovery document and the algorithm list the client loads when it starts. Swapping that
+# transport runs the whole pipeline (collections, composites, map ids, statistics) without network or credentials:
+#   - RecordingTransport forwards every request to Earth Engine and appends the request/response pair to a cassette
+#     (a JSON lines file)
+#   - ReplayTransport answers from a cassette: the same request always gets the same response. It is also a
+#     programmable fake: routes (method, uri pattern) -> handler take precedence over the cassette and every
+#     response can be delayed by a configurable latency, to benchmark the pipeline under a given EE latency.
+# A request missing from the cassette gets a 404 error response naming it, so replays fail loudly, never silently.
+#
+# Environment variables read by initialize(): MNDWI_EE_RECORD=<cassette> records, MNDWI_EE_REPLAY=<cassette> replays
+# (with MNDWI_EE_LATENCY=<seconds> added to every replayed response).
+
+# Project reported while replaying (requests are matched without it, see request_key)
+OFFLINE_PROJECT = 'offline'
+
+
+# Key of a request: method, uri and body, with the project of the uri (recording vs replaying) left out
+def request_key(method, uri, body=None):
+    uri = re.sub(r'/projects/[^/]+/', '/projects/_/', uri)
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    digest = hashlib.sha256(f"{method.upper()} {uri}\n".encode('utf-8'))
+    digest.update(body or b'')
+    return digest.hexdigest()
+
+
+def encode_content(content):
+    try:
+        return {'content': content.decode('utf-8')}
+    except UnicodeDecodeError:
+        return {'content_base64': base64.b64encode(content).decode('ascii')}
+
+
+def decode_content(entry):
+    if 'content_base64' in entry:
+        return base64.b64decode(entry['content_base64'])
+    return entry['content'].encode('utf-8')
+
+
+# httplib2 response of a recorded or programmed answer
+def http_response(status, content, headers=None):
+    response = httplib2.Response(dict(headers or {}, status=str(status)))
+    response.status = status
+    return response, content
+
+
+# {request key: cassette entry} of a cassette file
+def load_cassette(path):
+    with open(path, encoding='utf-8') as cassette_file:
+        entries = (json.loads(line) for line in cassette_file if line.strip())
+        return {entry['key']: entry for entry in entries}
+
+
+# Transport forwarding to Earth Engine and appending every exchange to a cassette
+class RecordingTransport:
+    def __init__(self, path, http=None):
+        self.path = path
+        self.http = http or httplib2.Http(timeout=120)
+        self._lock = threading.Lock()
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        response, content = self.http.request(uri, method=method, body=body, headers=headers, **kwargs)
+        entry = dict({
+            'key': request_key(method, uri, body),
+            'method': method,
+            'uri': uri,
+            'status': response.status,
+            'headers': {'content-type': response.get('content-type', 'application/json')},
+        }, **encode_content(content))
+        with self._lock, open(self.path, 'a', encoding='utf-8') as cassette_file:
+            cassette_file.write(json.dumps(entry) + '\n')
+        return response, content
+
+
+# Transport answering from programmed routes then from a cassette, after `latency` seconds
+# (a number, or a function of (method, uri) for per request latencies).
+# routes: [(method, uri regex, handler(uri, body) -> (status, JSON-serializable payload))]
+class ReplayTransport:
+    def __init__(self, cassette=None, routes=(), latency=0.0):
+        self.entries = load_cassette(cassette) if isinstance(cassette, str) else dict(cassette or {})
+        self.routes = [(method.upper(), re.compile(pattern), handler) for method, pattern, handler in routes]
+        self.latency = latency
+        self.requests = 0
+        self.misses = []
+        self._lock = threading.Lock()
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        with self._lock:
+            self.requests += 1
+        delay = self.latency(method, uri) if callable(self.latency) else self.latency
+        if delay:
+            time.sleep(delay)
+        for route_method, pattern, handler in self.routes:
+            if route_method == method.upper() and pattern.search(uri):
+                status, payload = handler(uri, body)
+                return http_response(status, json.dumps(payload).encode('utf-8'), {'content-type': 'application/json'})
+        entry = self.entries.get(request_key(method, uri, body))
+        if entry is None:
+            with self._lock:
+                self.misses.append((method, uri))
+            error = {'error': {'code': 404, 'status': 'NOT_FOUND', 'message': f"No recorded response for {method} {uri}"}}
+            return http_response(404, json.dumps(error).encode('utf-8'), {'content-type': 'application/json'})
+        return http_response(entry['status'], decode_content(entry), entry['headers'])
+
+
+# Initializing Earth Engine offline from a cassette (no credentials needed)
+def initialize_replay(cassette, routes=(), latency=0.0):
+    transport = ReplayTransport(cassette, routes, latency)
+    ee.Initialize(credentials=None, project=OFFLINE_PROJECT, http_transport=transport)
+    return transport
+
+
+# Transport of the process-wide initialization (None: the default one)
+_initialized = []
+_initialize_lock = threading.Lock()
+
+
+# Initializing Earth Engine once per process, the first time it is needed: later calls return right away.
+# Streamlit re-executes the app script on every rerun, but imported modules (and this flag) live as long as the process.
+# Thread safe: concurrent first sessions wait for a single initialization (which goes through the scheduler).
+def initialize_once(project=None, **kwargs):
+    if _initialized:
+        return _initialized[0]
+    with _initialize_lock:
+        if not _initialized:
+            start = time.perf_counter()
+            _initialized.append(ee_scheduler.call(initialize, project=project, **kwargs))
+            record_startup('ee_initialize', time.perf_counter() - start)
+    return _initialized[0]
+
+
+# Initializing Earth Engine, recording or replaying its requests when asked to by the environment
+def initialize(project=None, **kwargs):
+    replay = os.environ.get('MNDWI_EE_REPLAY')
+    if replay:
+        return initialize_replay(replay, latency=float(os.environ.get('MNDWI_EE_LATENCY', 0)))
+    record = os.environ.get('MNDWI_EE_RECORD')
+    if record:
+        kwargs['http_transport'] = RecordingTransport(record)
+    ee.Initialize(project=project, **kwargs)
+    return kwargs.get('http_transport')
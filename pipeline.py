@@ -0,0 +1,98 @@
+import json
+import threading
+from collections import Counter
+from cache import TTLCache
+from tracing import span, context_map
+
+#### Stage graph for the satellite processing section
+# Each stage is a function of the inputs it declares and of the results of its upstream stages.
+# A stage result is cached on exactly those: its key is made of its own input values and the keys of its
+# upstream stages, so changing one input only recomputes the stages downstream of it.
+# An upstream stage can also be given as (stage name, inputs name): it then runs on the inputs dict found under
+# that name, e.g. a stage comparing two dates runs the same upstream stage on the 'initial' and 'updated' inputs.
+# The graph only holds the stage definitions, results (and their hit/miss counters) live in a StageResults
+# object so they can be kept per session. Computed stages are timed as "stage <name>" spans (see tracing.py).
+
+
+# Hashable key of an input value: dicts and lists (e.g. vis params) are serialized
+def input_key(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True, default=str)
+    return value
+
+
+class Stage:
+    def __init__(self, name, func, inputs=(), upstream=()):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.upstream = tuple(upstream)
+
+
+# Cached stage results with hit/miss counters per stage
+class StageResults:
+    def __init__(self, maxsize=64, ttl=None):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = Counter()
+        self.misses = Counter()
+        self._lock = threading.Lock()
+
+    def count(self, name, hit):
+        with self._lock:
+            (self.hits if hit else self.misses)[name] += 1
+
+    # {stage name: {'hits': ..., 'misses': ...}}
+    def stats(self):
+        with self._lock:
+            return {name: {'hits': self.hits[name], 'misses': self.misses[name]} for name in sorted(set(self.hits) | set(self.misses))}
+
+
+class StageGraph:
+    def __init__(self):
+        self.stages = {}
+
+    # Decorator registering a stage: the function gets the upstream results (in order) then the inputs as keywords
+    def stage(self, name, inputs=(), upstream=()):
+        for dependency, _ in map(self.dependency, upstream):
+            if dependency not in self.stages:
+                raise ValueError(f"Stage {name!r} depends on unknown stage {dependency!r}")
+
+        def register(func):
+            self.stages[name] = Stage(name, func, inputs, upstream)
+            return func
+        return register
+
+    # (stage name, inputs name or None) of an upstream declaration
+    @staticmethod
+    def dependency(upstream):
+        return (upstream, None) if isinstance(upstream, str) else upstream
+
+    # Upstream stages of a stage with the inputs each one runs on
+    def upstream_inputs(self, stage, inputs):
+        for dependency, inputs_name in map(self.dependency, stage.upstream):
+            yield dependency, inputs if inputs_name is None else inputs[inputs_name]
+
+    # Cache key of a stage for the given inputs; keys overrides the key of inputs that are not hashable (e.g. an AOI)
+    def key(self, name, inputs, keys=None):
+        stage = self.stages[name]
+        keys = keys or {}
+        own = tuple(keys[input_name] if input_name in keys else input_key(inputs[input_name]) for input_name in stage.inputs)
+        return (name, own) + tuple(self.key(dependency, dependency_inputs, keys) for dependency, dependency_inputs in self.upstream_inputs(stage, inputs))
+
+    # Result of a stage, computing it (and the upstream stages it needs) only when it is not in results
+    def run(self, name, inputs, results, keys=None):
+        stage = self.stages[name]
+        key = self.key(name, inputs, keys)
+        value = results.cache.get(key)
+        results.count(name, value is not None)
+        if value is None:
+            upstream_values = [self.run(dependency, dependency_inputs, results, keys) for dependency, dependency_inputs in self.upstream_inputs(stage, inputs)]
+            with span(f"stage {name}"):
+                value = stage.func(*upstream_values, **{input_name: inputs[input_name] for input_name in stage.inputs})
+            results.cache.set(key, value)
+        return value
+
+    # Running several (stage name, inputs) requests, concurrently when an executor is given; results keep the order
+    def run_many(self, requests, results, keys=None, executor=None):
+        run = lambda request: self.run(request[0], request[1], results, keys)
+        return context_map(executor, run, requests) if executor is not None else list(map(run, requests))
@@ -0,0 +1,238 @@
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from engine import get_backend, MNDWI_CLASSES
+
+#### Chunked local raster processing
+# Runs the mndwi steps of the NumPy backend (normalized difference, mask, classification, see engine.py) over rasters
+# too large for memory, e.g. full Sentinel-2 tiles (10980 x 10980 pixels per band).
+# Bands are .npy files read window by window (blocks of full rows) with plain file reads, and each output window is
+# appended to its .npy file right away: only one window of each array is in memory at a time, whatever the raster size.
+# The window height comes from a memory budget (or is given), throughput and peak RSS are reported per run.
+# With several workers, each window is read into shared memory and its rows are split between worker processes, which
+# write their results into shared output buffers: only row numbers go through the pool, pixels are never pickled.
+
+# Default memory budget of the windows in flight
+DEFAULT_MEMORY_BUDGET = 256 << 20
+# Output files written in the output directory
+MNDWI_FILE = 'mndwi.npy'
+CLASSIFIED_FILE = 'classified.npy'
+# Worker processes of the parallel runs (the cores available to the process)
+PARALLEL_WORKERS = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+# Chunks of rows per worker and window: a few, so a slower worker doesn't hold the window back
+CHUNKS_PER_WORKER = 4
+
+
+# Shape, dtype and data offset of a .npy file, without reading its data
+def npy_layout(path):
+    with open(path, 'rb') as npy_file:
+        version = np.lib.format.read_magic(npy_file)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(npy_file)
+        if fortran_order:
+            raise ValueError(f"{path}: Fortran ordered arrays can't be read by rows")
+        return shape, dtype, npy_file.tell()
+
+
+# Rows [start, stop) of a 2D .npy file, read into the first rows of `out` (a C contiguous array) when given
+def read_rows(npy_file, shape, dtype, offset, start, stop, out=None):
+    row_size = shape[1] * dtype.itemsize
+    npy_file.seek(offset + start * row_size)
+    if out is None:
+        return np.fromfile(npy_file, dtype=dtype, count=(stop - start) * shape[1]).reshape(stop - start, shape[1])
+    rows = out[:stop - start]
+    if npy_file.readinto(memoryview(rows).cast('B')) != rows.nbytes:
+        raise ValueError(f"{npy_file.name}: file shorter than its header says")
+    return rows
+
+
+# New .npy file of the given shape and dtype, open for its rows to be appended in order
+def open_npy_writer(path, shape, dtype):
+    npy_file = open(path, 'wb')
+    np.lib.format.write_array_header_1_0(npy_file, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': tuple(shape)})
+    return npy_file
+
+
+# Resident memory of the process in bytes (Linux /proc, 0 elsewhere)
+def current_rss():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+# Bytes held per pixel of a window at the peak, inside NumpyBackend.normalized_difference: both bands as read and as
+# float32, the float32 difference, sum and index, then the finite pixel mask and the class written later
+def window_bytes_per_pixel(band_dtypes):
+    return sum(np.dtype(dtype).itemsize for dtype in band_dtypes) + 4 * len(band_dtypes) + 3 * 4 + 1 + 1
+
+
+# Bytes per pixel of the shared window buffers of a parallel run: both bands, the index and the class.
+# The workers' own temporaries add up to window_bytes_per_pixel() over the window at most.
+def shared_bytes_per_pixel(band_dtypes):
+    return sum(np.dtype(dtype).itemsize for dtype in band_dtypes) + 4 + 1
+
+
+# Rows per window fitting in the memory budget (at least one)
+def window_rows(shape, band_dtypes, memory_budget=DEFAULT_MEMORY_BUDGET, workers=1):
+    pixel_bytes = window_bytes_per_pixel(band_dtypes) + (shared_bytes_per_pixel(band_dtypes) if workers > 1 else 0)
+    return max(1, min(shape[0], memory_budget // (shape[1] * pixel_bytes)))
+
+
+# Masked mndwi (float32, NaN where masked) and class (uint8) of a window of both bands
+def mndwi_window(backend, green, swir, classes=MNDWI_CLASSES):
+    masked = backend.mask(backend.normalized_difference({'green': green, 'swir': swir}, ['green', 'swir']))
+    return masked, backend.classify(masked, classes)
+
+
+#### Shared memory worker pool
+# SharedMndwiPool holds four arrays of `shape` pixels (green, swir, mndwi, class) in shared memory blocks and a
+# process pool whose workers attach to the blocks once, when they start. run() splits the first rows of the arrays
+# into chunks, and each worker computes its chunks from the shared bands into the shared outputs.
+
+# Arrays of the blocks a worker process is attached to, and its classification settings
+_worker_arrays = {}
+
+
+def _attach_shared(specs, classes):
+    for key, (name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=name)
+        # the block objects must outlive their arrays
+        _worker_arrays[key + '_block'] = block
+        _worker_arrays[key] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    _worker_arrays['classes'] = classes
+    _worker_arrays['backend'] = get_backend("numpy")
+
+
+def _process_shared_rows(start, stop):
+    arrays = _worker_arrays
+    masked, classified = mndwi_window(arrays['backend'], arrays['green'][start:stop], arrays['swir'][start:stop], arrays['classes'])
+    arrays['mndwi'][start:stop] = masked
+    arrays['classified'][start:stop] = classified
+    return stop - start
+
+
+class SharedMndwiPool:
+    def __init__(self, shape, band_dtypes, classes=MNDWI_CLASSES, workers=PARALLEL_WORKERS):
+        self.shape = tuple(shape)
+        self.workers = workers
+        self._blocks = []
+        dtypes = {'green': band_dtypes[0], 'swir': band_dtypes[1], 'mndwi': np.float32, 'classified': np.uint8}
+        try:
+            specs = {}
+            for key, dtype in dtypes.items():
+                block, array = self._shared_array(dtype)
+                setattr(self, key, array)
+                specs[key] = (block.name, self.shape, np.dtype(dtype).str)
+            self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_attach_shared, initargs=(specs, classes))
+        except BaseException:
+            self._release_blocks()
+            raise
+
+    def _shared_array(self, dtype):
+        block = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(self.shape)) * np.dtype(dtype).itemsize))
+        self._blocks.append(block)
+        return block, np.ndarray(self.shape, dtype=dtype, buffer=block.buf)
+
+    # Computing mndwi and class of the first `rows` rows (all by default) into the shared outputs
+    def run(self, rows=None, chunk_rows=None):
+        rows = self.shape[0] if rows is None else rows
+        chunk_rows = chunk_rows or max(1, -(-rows // (self.workers * CHUNKS_PER_WORKER)))
+        starts = range(0, rows, chunk_rows)
+        # list() waits for every chunk and raises the first worker error
+        list(self.executor.map(_process_shared_rows, starts, [min(start + chunk_rows, rows) for start in starts]))
+
+    def _release_blocks(self):
+        # the arrays are views of the blocks, dropped before the blocks are closed
+        self.green = self.swir = self.mndwi = self.classified = None
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    def close(self):
+        self.executor.shutdown()
+        self._release_blocks()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+#### Runs
+
+# Processing a green and a swir band file (.npy, same shape) into mndwi (float32, NaN where masked) and class
+# (uint8) files in output_dir, window by window, on `workers` processes (1: in this process). Returns the run report
+# (peak RSS of this process: the shared windows count, the temporaries of the workers don't).
+def process_raster(green_path, swir_path, output_dir, classes=MNDWI_CLASSES, memory_budget=DEFAULT_MEMORY_BUDGET, chunk_rows=None, workers=1):
+    backend = get_backend("numpy")
+    green_shape, green_dtype, green_offset = npy_layout(green_path)
+    swir_shape, swir_dtype, swir_offset = npy_layout(swir_path)
+    if green_shape != swir_shape or len(green_shape) != 2:
+        raise ValueError(f"Bands must be 2D rasters of the same shape, got {green_shape} and {swir_shape}")
+    shape = green_shape
+    rows = chunk_rows or window_rows(shape, [green_dtype, swir_dtype], memory_budget, workers)
+
+    os.makedirs(output_dir, exist_ok=True)
+    start = time.perf_counter()
+    rss_before = peak_rss = current_rss()
+    pool = SharedMndwiPool((rows, shape[1]), [green_dtype, swir_dtype], classes, workers) if workers > 1 else None
+    try:
+        with open(green_path, 'rb') as green_file, open(swir_path, 'rb') as swir_file, \
+                open_npy_writer(os.path.join(output_dir, MNDWI_FILE), shape, np.float32) as mndwi_file, \
+                open_npy_writer(os.path.join(output_dir, CLASSIFIED_FILE), shape, np.uint8) as classified_file:
+            for row in range(0, shape[0], rows):
+                stop = min(row + rows, shape[0])
+                if pool is None:
+                    masked, classified = mndwi_window(backend, read_rows(green_file, shape, green_dtype, green_offset, row, stop),
+                                                      read_rows(swir_file, shape, swir_dtype, swir_offset, row, stop), classes)
+                else:
+                    read_rows(green_file, shape, green_dtype, green_offset, row, stop, out=pool.green)
+                    read_rows(swir_file, shape, swir_dtype, swir_offset, row, stop, out=pool.swir)
+                    pool.run(stop - row)
+                    masked, classified = pool.mndwi[:stop - row], pool.classified[:stop - row]
+                masked.tofile(mndwi_file)
+                classified.tofile(classified_file)
+                del masked, classified
+                peak_rss = max(peak_rss, current_rss())
+    finally:
+        if pool is not None:
+            pool.close()
+    elapsed = time.perf_counter() - start
+    pixels = shape[0] * shape[1]
+    return {
+        'shape': list(shape),
+        'workers': workers,
+        'chunk_rows': rows,
+        'chunks': -(-shape[0] // rows),
+        'seconds': elapsed,
+        'megapixels_per_second': pixels / elapsed / 1e6 if elapsed else 0.0,
+        'peak_rss_mb': peak_rss / 2 ** 20,
+        'rss_growth_mb': (peak_rss - rss_before) / 2 ** 20,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Chunked mndwi classification of large local rasters (.npy bands).")
+    parser.add_argument('green', help="green band (Sentinel-2 B3) .npy file")
+    parser.add_argument('swir', help="swir band (Sentinel-2 B11) .npy file")
+    parser.add_argument('--output', default='raster_output', help=f"output directory for {MNDWI_FILE} and {CLASSIFIED_FILE}")
+    parser.add_argument('--memory-budget', type=int, default=DEFAULT_MEMORY_BUDGET >> 20, help="memory budget of the windows in MB (default: 256)")
+    parser.add_argument('--chunk-rows', type=int, help="rows per window (default: from the memory budget)")
+    parser.add_argument('--workers', type=int, default=1, help=f"worker processes (default: 1, cores available: {PARALLEL_WORKERS})")
+    args = parser.parse_args(argv)
+    report = process_raster(args.green, args.swir, args.output, memory_budget=args.memory_budget << 20, chunk_rows=args.chunk_rows, workers=args.workers)
+    print(f"{report['shape'][0]}x{report['shape'][1]} pixels in {report['chunks']} windows of {report['chunk_rows']} rows on {report['workers']} worker(s): "
+          f"{report['seconds']:.2f} s, {report['megapixels_per_second']:.1f} Mpixel/s, peak RSS {report['peak_rss_mb']:.0f} MB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+import ee
+
+#### Earth Engine request scheduler
+# Every Earth Engine call (getMapId, getInfo, Initialize) goes through one process-wide scheduler:
+#   - at most max_concurrent calls run at the same time, for all sessions together
+#   - calls start at most `rate` per second on average (token bucket, bursts of up to `burst` calls)
+#   - calls failing with a throttling / quota error are retried after a jittered exponential backoff
+#   - waiting calls start in priority order: interactive map requests before background statistics
+# Other errors (invalid expression, memory limit...) are raised right away.
+
+# Priorities, lower starts first
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# Defaults of the process-wide scheduler
+EE_MAX_CONCURRENT = 8
+EE_REQUESTS_PER_SECOND = 10
+EE_BURST = 20
+EE_MAX_RETRIES = 5
+# Backoff: a random delay up to base * 2 ** attempt seconds, capped
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+# Error messages of the calls worth retrying later
+RETRYABLE_ERRORS = ('429', 'too many requests', 'quota', 'rate limit', 'too many concurrent', 'service unavailable', '503')
+
+
+def is_retryable_error(error):
+    return isinstance(error, ee.EEException) and any(message in str(error).lower() for message in RETRYABLE_ERRORS)
+
+
+class RequestScheduler:
+    def __init__(self, max_concurrent=EE_MAX_CONCURRENT, rate=EE_REQUESTS_PER_SECOND, burst=EE_BURST,
+                 max_retries=EE_MAX_RETRIES, backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX,
+                 retryable=is_retryable_error, clock=time.monotonic, sleep=time.sleep):
+        self.max_concurrent = max_concurrent
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retryable = retryable
+        self.clock = clock
+        self.sleep = sleep
+        self.running = 0
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self._tokens = burst
+        self._refilled = clock()
+        # waiting calls as (priority, arrival order) entries
+        self._waiting = []
+        self._order = itertools.count()
+        self._condition = threading.Condition()
+
+    # Adding the tokens earned since the last refill (condition held)
+    def _refill(self):
+        now = self.clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    # Waiting for a slot and a token, behind the waiting calls of higher priority (or same priority, arrived earlier)
+    def _acquire(self, priority):
+        entry = (priority, next(self._order))
+        with self._condition:
+            heapq.heappush(self._waiting, entry)
+            while True:
+                self._refill()
+                if self._waiting[0] == entry and self.running < self.max_concurrent:
+                    if self._tokens >= 1:
+                        break
+                    # time until the next token
+                    self._condition.wait((1 - self._tokens) / self.rate)
+                else:
+                    self._condition.wait()
+            heapq.heappop(self._waiting)
+            self._tokens -= 1
+            self.running += 1
+            self.calls += 1
+            # the next waiting call may be able to start too
+            self._condition.notify_all()
+
+    def _release(self):
+        with self._condition:
+            self.running -= 1
+            self._condition.notify_all()
+
+    # Backoff before a retry: "full jitter", uniform between 0 and the capped exponential delay
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    # Result of func(*args, **kwargs), run when the scheduler allows it and retried on throttling errors
+    def call(self, func, *args, priority=INTERACTIVE, **kwargs):
+        for attempt in itertools.count():
+            self._acquire(priority)
+            try:
+                return func(*args, **kwargs)
+            except Exception as error:
+                if not self.retryable(error) or attempt >= self.max_retries:
+                    with self._condition:
+                        self.failures += 1
+                    raise
+                with self._condition:
+                    self.retries += 1
+            finally:
+                self._release()
+            # the slot is given back while waiting
+            self.sleep(self.backoff(attempt))
+
+    # {'running', 'waiting', 'calls', 'retries', 'failures'}
+    def stats(self):
+        with self._condition:
+            return {'running': self.running, 'waiting': len(self._waiting), 'calls': self.calls, 'retries': self.retries, 'failures': self.failures}
+
+
+# Scheduler of every Earth Engine call of the process
+ee_scheduler = RequestScheduler()
@@ -0,0 +1,32 @@
+import streamlit as st
+from pipeline import StageResults
+from layers import MAP_ID_TTL
+
+#### Per session pipeline state
+# Streamlit sessions share the server process (and its module globals) but each one has its own st.session_state:
+# anything computed for one user is kept there, so concurrent sessions never overwrite each other.
+
+# Number of stage results kept per session (one run of the two-date view makes 22 of them)
+SESSION_RESULTS_SIZE = 64
+# Results include layer tile urls, they can't be kept longer than the map ids behind them
+SESSION_RESULTS_TTL = MAP_ID_TTL
+
+
+class PipelineState:
+    def __init__(self):
+        # Uploaded area of interest: EE geometry, content hashes of the files it comes from, centroid and bounds
+        self.aoi = None
+        # the uploaded features, one per polygon (for zonal statistics)
+        self.features = None
+        self.aoi_key = ()
+        self.centroid = None
+        self.bounds = None
+        # Stage results (composites, mndwi, layer urls...) of the satellite processing section (see pipeline.py)
+        self.stages = StageResults(maxsize=SESSION_RESULTS_SIZE, ttl=SESSION_RESULTS_TTL)
+
+
+# Pipeline state of the current session, created on its first run
+def get_pipeline_state():
+    if 'pipeline_state' not in st.session_state:
+        st.session_state['pipeline_state'] = PipelineState()
+    return st.session_state['pipeline_state']
@@ -0,0 +1,106 @@
+import ee
+from pipeline import StageGraph
+from collection import sat_collection, composite_scenes, sat_composite
+from engine import get_backend
+from layers import map_tile_url, get_info
+from scheduler import INTERACTIVE
+from zonal import zonal_class_areas, zonal_rows, region_statistics, merge_region_statistics, tile_features, merge_zonal_info
+from tiles import tile_grid, tile_region, run_tiles
+
+#### mndwi processing stages
+# The satellite processing pipeline shared by the Streamlit apps and the batch runner.
+# Each stage is cached on the inputs it depends on (see pipeline.py): a palette change only redoes the layers,
+# a cloud rate change redoes the collection onward.
+#
+# Inputs of a date: aoi, cloud_rate, start_date, end_date, composite_mode, scene_limit,
+# tci_params, mndwi_params, mndwi_classified_params (layers), features, aoi_bounds, zonal_scale, tile_scale (statistics)
+
+
+# Building the stage graph of a sensor (see collection.py), computed through the Earth Engine backend
+def build_mndwi_pipeline(sensor):
+    pipeline = StageGraph()
+    backend = get_backend("ee")
+
+    # Image collection of a date range over the area of interest, with only the bands used downstream
+    @pipeline.stage('collection', inputs=('aoi', 'cloud_rate', 'start_date', 'end_date'))
+    def collection_stage(aoi, cloud_rate, start_date, end_date):
+        return sat_collection(sensor, cloud_rate, start_date, end_date, aoi)
+
+    # Scenes going into the composite, depending on the compositing mode
+    @pipeline.stage('scenes', inputs=('composite_mode', 'scene_limit'), upstream=('collection',))
+    def scenes_stage(collection, composite_mode, scene_limit):
+        return composite_scenes(sensor, collection, composite_mode, scene_limit)
+
+    # Number of scenes behind a composite (one getInfo round trip, shared by every session, see layers.py),
+    # shown under the map like an interactive request
+    @pipeline.stage('scene_count', upstream=('scenes',))
+    def scene_count_stage(scenes):
+        return get_info(scenes.size(), priority=INTERACTIVE)
+
+    # Composite clipped to the area of interest: used for TCI and mndwi
+    @pipeline.stage('composite', inputs=('aoi', 'composite_mode'), upstream=('scenes',))
+    def composite_stage(scenes, aoi, composite_mode):
+        return sat_composite(sensor, scenes, aoi, composite_mode)
+
+    @pipeline.stage('mndwi', upstream=('composite',))
+    def mndwi_stage(composite):
+        return backend.normalized_difference(composite, sensor['mndwi_bands'])
+
+    # Masking mndwi over the water & show only land
+    @pipeline.stage('masked_mndwi', upstream=('mndwi',))
+    def masked_mndwi_stage(mndwi):
+        return backend.mask(mndwi)
+
+    # mndwi classification: better use a masked image to avoid water bodies obstracting the result as possible
+    @pipeline.stage('classified_mndwi', upstream=('masked_mndwi',))
+    def classified_mndwi_stage(masked_mndwi):
+        return backend.classify(masked_mndwi, sensor['mndwi_classes'])
+
+    # Visualization: map layer tile urls, depending on the visual parameters (palettes)
+    @pipeline.stage('tci_layer', inputs=('tci_params',), upstream=('composite',))
+    def tci_layer_stage(composite, tci_params):
+        return map_tile_url(ee.Image(composite), tci_params)
+
+    @pipeline.stage('mndwi_layer', inputs=('mndwi_params',), upstream=('masked_mndwi',))
+    def mndwi_layer_stage(masked_mndwi, mndwi_params):
+        return map_tile_url(ee.Image(masked_mndwi), mndwi_params)
+
+    @pipeline.stage('classified_mndwi_layer', inputs=('mndwi_classified_params',), upstream=('classified_mndwi',))
+    def classified_mndwi_layer_stage(classified_mndwi, mndwi_classified_params):
+        return map_tile_url(ee.Image(classified_mndwi), mndwi_classified_params)
+
+    # Zonal statistics: hectares of each mndwi class per AOI feature, one reduceRegions call per tile of the AOI
+    # (a single one unless the AOI is large, see tiles.py & zonal.py)
+    @pipeline.stage('zonal_stats', inputs=('features', 'aoi_bounds', 'zonal_scale', 'tile_scale'), upstream=('classified_mndwi',))
+    def zonal_stats_stage(classified_mndwi, features, aoi_bounds, zonal_scale, tile_scale):
+        tiles = tile_grid(aoi_bounds, zonal_scale)
+
+        def tile_zonal_info(tile):
+            tile_collection = features if tiles == [tile] else tile_features(features, tile_region(tile))
+            return get_info(zonal_class_areas(classified_mndwi, tile_collection, zonal_scale, tile_scale))
+        zonal_info = merge_zonal_info(run_tiles(tile_zonal_info, tiles))
+        return zonal_rows(zonal_info, [value for _, _, value in sensor['mndwi_classes']])
+
+    # Statistics of the whole AOI (scene count, class areas, mean mndwi), one getInfo round trip per tile (time series)
+    @pipeline.stage('region_stats', inputs=('aoi_bounds', 'zonal_scale', 'tile_scale'), upstream=('scenes', 'mndwi', 'classified_mndwi'))
+    def region_stats_stage(scenes, mndwi, classified_mndwi, aoi_bounds, zonal_scale, tile_scale):
+        tiles = tile_grid(aoi_bounds, zonal_scale)
+        return merge_region_statistics(run_tiles(
+            lambda tile: get_info(region_statistics(scenes, mndwi, classified_mndwi, tile_region(tile), zonal_scale, tile_scale)), tiles))
+
+    # Flood change between the two dates: mndwi difference & class transition bands in one image
+    # Runs on {'initial': initial date inputs, 'updated': updated date inputs, 'change_params': ...}
+    @pipeline.stage('change', upstream=(('mndwi', 'initial'), ('mndwi', 'updated'), ('classified_mndwi', 'initial'), ('classified_mndwi', 'updated')))
+    def change_stage(initial_mndwi, updated_mndwi, initial_classified, updated_classified):
+        return backend.change(initial_mndwi, updated_mndwi, initial_classified, updated_classified)
+
+    @pipeline.stage('change_layer', inputs=('change_params',), upstream=('change',))
+    def change_layer_stage(change, change_params):
+        return map_tile_url(ee.Image(change), change_params)
+
+    # Class transitions (from * 10 + to) of the same image, see engine.transition_vis_params
+    @pipeline.stage('transition_layer', inputs=('transition_params',), upstream=('change',))
+    def transition_layer_stage(change, transition_params):
+        return map_tile_url(ee.Image(change), transition_params)
+
+    return pipeline
@@ -0,0 +1,171 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import ee
+import pytest
+from scheduler import RequestScheduler, INTERACTIVE, BACKGROUND
+
+#### RequestScheduler against a fake Earth Engine client
+# The scheduler's clock and sleep are fakes: token refills only happen when a test advances the clock, and backoff
+# delays are recorded instead of slept. Blocked calls are observed through stats(), never by sleeping.
+
+THROTTLED = "Too Many Requests: Request was rejected because the request rate or concurrency limit was exceeded."
+# Real seconds a test waits for threads to reach an expected state before failing
+TIMEOUT = 5
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+
+# Fake client failing with a throttling (or other) error for its first `failures` calls
+class FakeClient:
+    def __init__(self, failures=0, error=THROTTLED):
+        self.failures = failures
+        self.error = error
+        self.calls = 0
+
+    def call(self, value):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise ee.EEException(self.error)
+        return value
+
+
+def scheduler_with(clock, **kwargs):
+    options = dict(max_concurrent=4, rate=100, burst=100, max_retries=5, clock=clock, sleep=clock.sleep)
+    return RequestScheduler(**dict(options, **kwargs))
+
+
+# Waiting (in real time) until the scheduler stats match
+def wait_for(scheduler, **expected):
+    deadline = time.monotonic() + TIMEOUT
+    while time.monotonic() < deadline:
+        stats = scheduler.stats()
+        if all(stats[name] == value for name, value in expected.items()):
+            return
+        time.sleep(0.001)
+    pytest.fail(f"scheduler stats {scheduler.stats()} never reached {expected}")
+
+
+def test_concurrency_cap():
+    clock = FakeClock()
+    scheduler = scheduler_with(clock, max_concurrent=2)
+    release = threading.Event()
+    running, max_running = [0], [0]
+    lock = threading.Lock()
+
+    def blocking_call():
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        release.wait(TIMEOUT)
+        with lock:
+            running[0] -= 1
+
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        calls = [executor.submit(scheduler.call, blocking_call) for _ in range(5)]
+        wait_for(scheduler, running=2, waiting=3)
+        release.set()
+        for call in calls:
+            call.result(TIMEOUT)
+    assert max_running[0] == 2
+    assert scheduler.stats() == {'running': 0, 'waiting': 0, 'calls': 5, 'retries': 0, 'failures': 0}
+
+
+def test_token_bucket_pacing():
+    clock = FakeClock()
+    scheduler = scheduler_with(clock, rate=10, burst=3)
+    # a full bucket: a burst of 3 calls starts right away
+    assert [scheduler.call(FakeClient().call, index) for index in range(3)] == [0, 1, 2]
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        call = executor.submit(scheduler.call, FakeClient().call, 'paced')
+        # the bucket is empty and the clock stands still: the 4th call waits for a token
+        wait_for(scheduler, waiting=1, calls=3)
+        assert not call.done()
+        clock.advance(0.1)
+        assert call.result(TIMEOUT) == 'paced'
+    # a long idle time refills the bucket up to the burst size only
+    clock.advance(100)
+    for index in range(3):
+        scheduler.call(FakeClient().call, index)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        call = executor.submit(scheduler.call, FakeClient().call, 'paced')
+        wait_for(scheduler, waiting=1, calls=7)
+        clock.advance(0.1)
+        call.result(TIMEOUT)
+
+
+def test_throttled_call_is_retried_with_backoff():
+    clock = FakeClock()
+    scheduler = scheduler_with(clock, max_retries=5, backoff_base=0.5, backoff_max=30)
+    client = FakeClient(failures=3)
+    assert scheduler.call(client.call, 'value') == 'value'
+    assert client.calls == 4
+    assert len(clock.sleeps) == 3
+    # full jitter: each delay is between 0 and base * 2 ** attempt
+    assert all(0 <= delay <= 0.5 * 2 ** attempt for attempt, delay in enumerate(clock.sleeps))
+    assert scheduler.stats() == {'running': 0, 'waiting': 0, 'calls': 4, 'retries': 3, 'failures': 0}
+
+
+def test_gives_up_after_max_retries():
+    clock = FakeClock()
+    scheduler = scheduler_with(clock, max_retries=2)
+    client = FakeClient(failures=10)
+    with pytest.raises(ee.EEException, match="Too Many Requests"):
+        scheduler.call(client.call, 'value')
+    assert client.calls == 3
+    assert len(clock.sleeps) == 2
+    assert scheduler.stats() == {'running': 0, 'waiting': 0, 'calls': 3, 'retries': 2, 'failures': 1}
+
+
+@pytest.mark.parametrize('error', [ee.EEException("Image.load: Image asset not found."), ValueError("bad input")])
+def test_other_errors_are_raised_right_away(error):
+    clock = FakeClock()
+    scheduler = scheduler_with(clock)
+    calls = []
+
+    def failing_call():
+        calls.append(1)
+        raise error
+
+    with pytest.raises(type(error)):
+        scheduler.call(failing_call)
+    assert len(calls) == 1
+    assert clock.sleeps == []
+    assert scheduler.stats()['failures'] == 1
+
+
+def test_interactive_calls_start_before_background_ones():
+    clock = FakeClock()
+    scheduler = scheduler_with(clock, max_concurrent=1)
+    release = threading.Event()
+    started = []
+
+    def record(name):
+        started.append(name)
+
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        # holds the only slot while the other calls queue up
+        first = executor.submit(scheduler.call, lambda: release.wait(TIMEOUT), priority=BACKGROUND)
+        wait_for(scheduler, running=1)
+        background = [executor.submit(scheduler.call, record, f'background {index}', priority=BACKGROUND) for index in range(3)]
+        wait_for(scheduler, waiting=3)
+        interactive = [executor.submit(scheduler.call, record, f'interactive {index}', priority=INTERACTIVE) for index in range(2)]
+        wait_for(scheduler, waiting=5)
+        release.set()
+        for call in [first] + background + interactive:
+            call.result(TIMEOUT)
+    # higher priority first, arrival order within a priority
+    assert started == ['interactive 0', 'interactive 1', 'background 0', 'background 1', 'background 2']
@@ -0,0 +1,77 @@
+import math
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import ee
+from aoi import METERS_PER_DEGREE
+from tracing import submit
+
+#### Tiled statistics for large AOIs
+# A reduction over a whole province at 10 m reads billions of pixels and fails with "User memory limit exceeded"
+# or a computation timeout. The AOI bounds are split into a grid of tiles sized from their area and the scale,
+# each tile is reduced on its own (a bounded number at a time) and the partial results are merged by the caller:
+# class area histograms are summed, so the merged statistics are the same as one reduction over the whole AOI.
+# The images reduced are clipped to the AOI, tiles only need to be rectangles partitioning its bounds.
+# A tile failing for lack of resources is split in four and its quarters are reduced instead.
+# Tiles are bounds [west, south, east, north] in degrees.
+
+# Pixels reduced per tile at most
+TILE_PIXELS = 1 << 24
+# Tiles reduced at the same time (per reduction)
+TILE_WORKERS = 4
+# Times a failing tile can be split in four before giving up
+MAX_TILE_SPLITS = 2
+# Earth Engine errors that a smaller tile can avoid
+RESOURCE_ERRORS = ('memory limit exceeded', 'computation timed out', 'too many pixels')
+
+
+# Grid of tiles covering bounds with at most tile_pixels pixels of scale meters each
+# (a single tile, the bounds themselves, when they are small enough)
+def tile_grid(bounds, scale, tile_pixels=TILE_PIXELS):
+    west, south, east, north = bounds
+    width = (east - west) * METERS_PER_DEGREE * math.cos(math.radians((south + north) / 2))
+    height = (north - south) * METERS_PER_DEGREE
+    tile_count = math.ceil(width * height / scale ** 2 / tile_pixels)
+    if tile_count <= 1:
+        return [list(bounds)]
+    # as square as possible tiles: columns and rows follow the aspect ratio of the bounds
+    columns = max(1, round(math.sqrt(tile_count * width / height))) if height else tile_count
+    rows = math.ceil(tile_count / columns)
+    step_x, step_y = (east - west) / columns, (north - south) / rows
+    return [[west + column * step_x, south + row * step_y, west + (column + 1) * step_x, south + (row + 1) * step_y]
+            for row in range(rows) for column in range(columns)]
+
+
+# Quarters of a tile
+def split_tile(tile):
+    west, south, east, north = tile
+    middle_x, middle_y = (west + east) / 2, (south + north) / 2
+    return [[west, south, middle_x, middle_y], [middle_x, south, east, middle_y],
+            [west, middle_y, middle_x, north], [middle_x, middle_y, east, north]]
+
+
+# Planar rectangle of a tile: neighbouring tiles share their edges exactly
+def tile_region(tile):
+    return ee.Geometry.Rectangle(tile, proj='EPSG:4326', geodesic=False)
+
+
+def is_resource_error(error):
+    return isinstance(error, ee.EEException) and any(message in str(error).lower() for message in RESOURCE_ERRORS)
+
+
+# Results of compute(tile) over every tile, running at most `workers` at once.
+# A tile failing with a resource error is replaced by its quarters (up to max_splits times), so the results
+# may outnumber the tiles: they are partial results to merge, in no particular order.
+def run_tiles(compute, tiles, workers=TILE_WORKERS, max_splits=MAX_TILE_SPLITS):
+    results = []
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ee-tile") as executor:
+        pending = {submit(executor, compute, tile): (tile, 0) for tile in tiles}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                tile, splits = pending.pop(future)
+                try:
+                    results.append(future.result())
+                except Exception as error:
+                    if not is_resource_error(error) or splits >= max_splits:
+                        raise
+                    pending.update({submit(executor, compute, quarter): (quarter, splits + 1) for quarter in split_tile(tile)})
+    return results
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from zonal import class_hectares
+from tracing import context_map
+
+#### Incremental mndwi time series
+# Statistics of an AOI over consecutive windows (scene count, class areas, mean mndwi), one 'region_stats' stage
+# run per window (see stages.py). Each window result is stored in a local SQLite file keyed by the series
+# (AOI content hash, sensor, cloud rate, compositing) and the window dates, so only windows missing from the store
+# are computed: re-opening a series reads it back without any Earth Engine request, extending it by one week
+# computes one window.
+# Windows are aligned on fixed dates (every `days` days from WINDOW_EPOCH), not on the requested range: a series
+# requested later, or over a longer range, ends up on the same windows and reuses them.
+
+# Local store of the window statistics (overridden with the MNDWI_TIMESERIES_DB environment variable)
+TIMESERIES_DB = os.environ.get('MNDWI_TIMESERIES_DB', 'mndwi_timeseries.sqlite')
+# Windows end on this date plus a multiple of their length (a Monday: weekly windows end on Mondays)
+WINDOW_EPOCH = date(2000, 1, 3)
+# Windows computed at the same time
+TIMESERIES_WORKERS = 4
+# Scenes keep being ingested for a few days after they are acquired: more recent windows are computed but not stored
+SETTLE_DAYS = 5
+
+
+# Consecutive aligned windows of `days` days covering from..to, as (start, end) 'YYYY-MM-DD' strings, oldest first.
+# The last window is the last aligned one ending on or before `to`.
+def series_windows(from_date, to_date, days=7):
+    last_end = to_date - timedelta(days=(to_date - WINDOW_EPOCH).days % days)
+    windows = []
+    end = last_end
+    while end > from_date:
+        windows.append(((end - timedelta(days=days)).isoformat(), end.isoformat()))
+        end -= timedelta(days=days)
+    return windows[::-1]
+
+
+# Key of a series: the window statistics only depend on the AOI content and on these processing parameters
+def series_key(aoi_key, sensor, cloud_rate, composite_mode, scene_limit=None, scale=None):
+    parameters = [aoi_key, sensor['collection'], cloud_rate, composite_mode, scene_limit, scale]
+    return hashlib.sha256(json.dumps(parameters, default=str).encode('utf-8')).hexdigest()
+
+
+# Window statistics stored in SQLite: one row per (series, window), the statistics as JSON.
+# A connection is opened per call (sqlite3 connections can't be shared between threads), writes are serialized.
+class TimeSeriesStore:
+    def __init__(self, path=TIMESERIES_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS windows ("
+                "series TEXT NOT NULL, start_date TEXT NOT NULL, end_date TEXT NOT NULL, "
+                "stats TEXT NOT NULL, computed_at REAL NOT NULL, "
+                "PRIMARY KEY (series, start_date, end_date))")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    # Stored statistics of the given windows of a series: {(start, end): stats}, missing windows are left out
+    def get(self, series, windows):
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT start_date, end_date, stats FROM windows WHERE series = ? AND end_date BETWEEN ? AND ?",
+                (series, min(end for _, end in windows), max(end for _, end in windows))).fetchall() if windows else []
+        wanted = set(windows)
+        return {(start, end): json.loads(stats) for start, end, stats in rows if (start, end) in wanted}
+
+    def put(self, series, window, stats):
+        with self._lock, self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO windows (series, start_date, end_date, stats, computed_at) VALUES (?, ?, ?, ?, ?)",
+                (series, window[0], window[1], json.dumps(stats), time.time()))
+
+
+# Statistics of every window of a series, computing (concurrently) and storing only the windows missing from the store.
+# inputs are stage inputs (their dates are replaced by each window's), keys the stage graph key overrides (e.g. the AOI hash).
+# Returns [(window, stats)] oldest first and the number of windows computed.
+def run_series(pipeline, results, store, series, windows, inputs, keys=None, workers=TIMESERIES_WORKERS):
+    stored = store.get(series, windows)
+    missing = [window for window in windows if window not in stored]
+    settled = (date.today() - timedelta(days=SETTLE_DAYS)).isoformat()
+
+    def compute(window):
+        stats = pipeline.run('region_stats', dict(inputs, start_date=window[0], end_date=window[1]), results, keys)
+        # windows without any scene are stored too, so they aren't requested again
+        if window[1] <= settled:
+            store.put(series, window, stats)
+        return stats
+
+    if missing:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(missing)))) as executor:
+            stored.update(zip(missing, context_map(executor, compute, missing)))
+    return [(window, stored[window]) for window in windows], len(missing)
+
+
+# Table rows of a series (one per window): window dates, scene count, mean mndwi and hectares per class
+def series_rows(series_stats, classes):
+    rows = []
+    for (start, end), stats in series_stats:
+        row = {'start': start, 'end': end, 'scene_count': stats['scene_count'], 'mndwi_mean': stats['mndwi_mean']}
+        row.update(class_hectares(stats['class_areas'], classes))
+        rows.append(row)
+    return rows
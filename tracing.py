@@ -0,0 +1,127 @@
+import contextlib
+import json
+import sys
+import threading
+import time
+import uuid
+from contextvars import ContextVar, copy_context
+from cache import json_size
+
+#### Timing spans & Earth Engine request accounting
+# A Tracer collects the spans (name, duration, attributes) and the Earth Engine requests (kind, duration, request and
+# response payload sizes) of one run: one rerun of the app or one batch job.
+# The tracer of the current run is held in a context variable, so concurrent sessions each record their own run;
+# work handed to executor threads carries it along when submitted with submit()/context_map().
+# Without an active tracer span() returns a shared no-op context manager and requests are not measured at all,
+# which keeps the cost of disabled tracing to a context variable lookup.
+
+current_tracer = ContextVar('current_tracer', default=None)
+
+NULL_SPAN = contextlib.nullcontext()
+# Runs of several threads can be exported to the same log file
+_export_lock = threading.Lock()
+
+
+class Tracer:
+    def __init__(self, **attributes):
+        self.run_id = uuid.uuid4().hex
+        self.attributes = attributes
+        self.started = time.time()
+        self.spans = []
+        self.requests = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with self._lock:
+                self.spans.append({'name': name, 'duration_ms': round(duration * 1000, 3), 'thread': threading.current_thread().name, **attributes})
+
+    def request(self, kind, duration, request_bytes, response_bytes):
+        with self._lock:
+            self.requests.append({'kind': kind, 'duration_ms': round(duration * 1000, 3), 'request_bytes': request_bytes, 'response_bytes': response_bytes})
+
+    # Table rows per span name: count and total / max duration
+    def span_summary(self):
+        summary = {}
+        with self._lock:
+            for span in self.spans:
+                row = summary.setdefault(span['name'], {'span': span['name'], 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+                row['count'] += 1
+                row['total_ms'] = round(row['total_ms'] + span['duration_ms'], 3)
+                row['max_ms'] = max(row['max_ms'], span['duration_ms'])
+        return list(summary.values())
+
+    # Table rows per request kind: count, total duration and payload sizes
+    def request_summary(self):
+        summary = {}
+        with self._lock:
+            for request in self.requests:
+                row = summary.setdefault(request['kind'], {'request': request['kind'], 'count': 0, 'total_ms': 0.0, 'request_bytes': 0, 'response_bytes': 0})
+                row['count'] += 1
+                row['total_ms'] = round(row['total_ms'] + request['duration_ms'], 3)
+                row['request_bytes'] += request['request_bytes']
+                row['response_bytes'] += request['response_bytes']
+        return list(summary.values())
+
+    # JSON lines of the run: one line per span and per request, each with the run id, time and attributes
+    def jsonl(self):
+        common = dict(self.attributes, run_id=self.run_id, time=self.started)
+        with self._lock:
+            lines = [dict(common, type='span', **span) for span in self.spans] + [dict(common, type='request', **request) for request in self.requests]
+        return ''.join(json.dumps(line, default=str) + '\n' for line in lines)
+
+    # Appending the JSON lines of the run to a log file
+    def export(self, path):
+        lines = self.jsonl()
+        with _export_lock, open(path, 'a', encoding='utf-8') as log_file:
+            log_file.write(lines)
+
+
+# Span of the current run (a no-op without active tracer)
+def span(name, **attributes):
+    tracer = current_tracer.get()
+    return tracer.span(name, **attributes) if tracer is not None else NULL_SPAN
+
+
+# Result of an Earth Engine call, recording its duration and payload sizes when a run is traced
+# (request size: the serialized expression, response size: the JSON of the result)
+def traced_request(kind, ee_object, call):
+    tracer = current_tracer.get()
+    if tracer is None:
+        return call()
+    start = time.perf_counter()
+    result = call()
+    tracer.request(kind, time.perf_counter() - start, len(ee_object.serialize()), json_size(result))
+    return result
+
+
+# Cold start timings of the process, {step: seconds} (module imports, Earth Engine initialization...)
+startup_timings = {}
+
+
+# Recording how long a startup step took, the first time only (later calls are warm: modules already imported...)
+# and reporting it once on stderr for the container logs
+def record_startup(step, seconds):
+    if step not in startup_timings:
+        startup_timings[step] = seconds
+        print(f"startup {step}: {seconds * 1000:.1f} ms", file=sys.stderr)
+
+
+# Table rows of the startup timings
+def startup_summary():
+    return [{'step': step, 'ms': round(seconds * 1000, 1)} for step, seconds in startup_timings.items()]
+
+
+# executor.submit() running fn in a copy of the current context (the tracer of the run goes along)
+def submit(executor, fn, *args, **kwargs):
+    return executor.submit(copy_context().run, fn, *args, **kwargs)
+
+
+# executor.map() of fn over items, each call running in a copy of the current context, results in order
+def context_map(executor, fn, items):
+    return [future.result() for future in [submit(executor, fn, item) for item in items]]
@@ -0,0 +1,106 @@
+import csv
+import io
+import ee
+
+#### Zonal flood statistics
+# Area of each mndwi class inside each AOI feature, for all features in a single reduceRegions call:
+# a frequency histogram of the class band weighted by the pixel area gives square meters per class.
+# The same reducer over the whole AOI gives the per window statistics of the time series.
+# Large AOIs are reduced tile by tile (see tiles.py), the partial results are merged here.
+
+# Property holding the feature identifier in the AOI feature collection
+FEATURE_ID = 'aoi_id'
+SQUARE_METERS_PER_HECTARE = 10000
+
+
+# Per feature class areas as an ee.FeatureCollection with a 'histogram' property ({class: m2})
+# tile_scale > 1 splits the computation into smaller tiles when Earth Engine runs out of memory
+def zonal_class_areas(classified, features, scale, tile_scale=1):
+    image = ee.Image(classified).rename('class').addBands(ee.Image.pixelArea())
+    reducer = ee.Reducer.frequencyHistogram().splitWeights()
+    return image.reduceRegions(collection=features, reducer=reducer, scale=scale, tileScale=tile_scale)
+
+
+# Statistics of a whole region (or of one tile of it, see tiles.py) as an ee.Dictionary: scene count,
+# class areas ({class: m2}) and the pixel weighted sum of mndwi with its total weight, which add up across tiles
+def region_statistics(scenes, mndwi, classified, region, scale, tile_scale=1):
+    class_areas = ee.Image(classified).rename('class').addBands(ee.Image.pixelArea()).reduceRegion(
+        reducer=ee.Reducer.frequencyHistogram().splitWeights(), geometry=region, scale=scale, tileScale=tile_scale, maxPixels=1e10)
+    # the weight band is 1 wherever mndwi is not masked: its weighted sum is the weight of the mean EE would compute
+    mndwi = ee.Image(mndwi).rename('mndwi')
+    mndwi_sums = mndwi.addBands(mndwi.multiply(0).add(1).rename('weight')).reduceRegion(
+        reducer=ee.Reducer.sum(), geometry=region, scale=scale, tileScale=tile_scale, maxPixels=1e10)
+    statistics = ee.Dictionary({
+        'scene_count': scenes.size(),
+        'class_areas': class_areas.get('histogram'),
+        'mndwi_sum': mndwi_sums.get('mndwi'),
+        'mndwi_weight': mndwi_sums.get('weight'),
+    })
+    # a window without scenes has an empty composite (no bands to reduce)
+    empty = ee.Dictionary({'scene_count': 0, 'class_areas': {}, 'mndwi_sum': 0, 'mndwi_weight': 0})
+    return ee.Dictionary(ee.Algorithms.If(scenes.size().gt(0), statistics, empty))
+
+
+# Sum of {class: m2} histograms
+def merge_histograms(histograms):
+    merged = {}
+    for histogram in histograms:
+        for value, area in (histogram or {}).items():
+            merged[value] = merged.get(value, 0) + area
+    return merged
+
+
+# Region statistics from the getInfo() of region_statistics over one or several tiles of the region,
+# with the mean mndwi (None when no pixel was reduced)
+def merge_region_statistics(parts):
+    mndwi_sum = sum(part['mndwi_sum'] or 0 for part in parts)
+    mndwi_weight = sum(part['mndwi_weight'] or 0 for part in parts)
+    return {
+        # every tile reduces the same scenes
+        'scene_count': max(part['scene_count'] for part in parts),
+        'class_areas': merge_histograms(part['class_areas'] for part in parts),
+        'mndwi_mean': mndwi_sum / mndwi_weight if mndwi_weight else None,
+    }
+
+
+# Features of a tile, cut to it (features not reaching the tile are left out)
+def tile_features(features, region):
+    return ee.FeatureCollection(features).filterBounds(region).map(lambda feature: feature.intersection(ee.Feature(region), ee.ErrorMargin(1)))
+
+
+# getInfo() of zonal_class_areas over the tiles of the AOI merged into one: histograms of the same feature are summed
+def merge_zonal_info(parts):
+    features = {}
+    for part in parts:
+        for feature in part['features']:
+            properties = feature['properties']
+            merged = features.setdefault(properties.get(FEATURE_ID), {'properties': dict(properties, histogram={})})
+            merged['properties']['histogram'] = merge_histograms([merged['properties']['histogram'], properties.get('histogram')])
+    return {'features': list(features.values())}
+
+
+# Hectares per class columns from a {class: m2} histogram (class keys come back from Earth Engine as strings)
+def class_hectares(histogram, classes):
+    histogram = {int(float(value)): area for value, area in (histogram or {}).items()}
+    return {f'class {value} (ha)': round(histogram.get(value, 0) / SQUARE_METERS_PER_HECTARE, 4) for value in classes}
+
+
+# Table rows (one per feature) from the getInfo() of zonal_class_areas: feature id, name and hectares per class
+def zonal_rows(zonal_info, classes):
+    rows = []
+    for feature in zonal_info['features']:
+        properties = feature['properties']
+        row = {FEATURE_ID: properties.get(FEATURE_ID), 'name': properties.get('name')}
+        row.update(class_hectares(properties.get('histogram'), classes))
+        rows.append(row)
+    return rows
+
+
+# CSV text of table rows
+def rows_csv(rows):
+    output = io.StringIO()
+    if rows:
+        writer = csv.DictWriter(output, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    return output.getvalue()